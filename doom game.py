@@ -4,6 +4,14 @@ import random
 import math
 import time
 import sys
+import os
+import json
+import hashlib
+import pickle
+import multiprocessing
+import concurrent.futures
+import threading
+import queue
 
 # --- Constants ---
 SCREEN_WIDTH = 640
@@ -75,7 +83,11 @@ MAX_LEVELS = len(LEVELS)
 
 # --- Global Game State ---
 current_level_index = 0
-MAP_GRID = []
+MAP_GRID = None # LevelGrid of the current level, set by load_level
+PVS = None # VisibilitySets over MAP_GRID
+FLOW = None # FlowField over MAP_GRID, toward the player
+LEVEL_START = (0.0, 0.0, 0.0) # Player start (x, y, angle) of the current level, set by load_level
+LEVEL_MUSIC = None # Music key of the current level, set by load_level
 MAP_WIDTH = 0
 MAP_HEIGHT = 0
 TILE_SIZE = 64
@@ -84,8 +96,8 @@ TILE_SIZE = 64
 player_x = 3.5
 player_y = 3.5
 player_angle = math.pi / 4
-player_speed = 0.1
-player_rot_speed = 0.05
+player_speed = 3.0 # Units per second
+player_rot_speed = 1.5 # Radians per second
 player_health = 100
 player_max_health = 100
 player_ammo = 50
@@ -94,15 +106,17 @@ player_clip_size = 10
 player_is_reloading = False
 player_reload_start_time = 0
 player_reload_time = 1.5
+player_last_pain_time = float('-inf')
+player_pain_cooldown = 0.5
 FOV = math.pi / 3
 
 # --- Graphics ---
 TEX_WIDTH = 64
 TEX_HEIGHT = 64
+MINIMAP_TILES = 32 # Largest map span the debug map shows around the player
 textures = {}
 
 # --- Sprites ---
-sprites = []
 sprite_textures = {}
 
 # --- Sound ---
@@ -110,7 +124,7 @@ SAMPLE_RATE = 44100
 AUDIO_FORMAT = -16
 AUDIO_CHANNELS = 2 # Ensure Stereo
 AUDIO_BUFFER = 512
-music_channel = None
+music_channel = None # MusicStreamer for the current level, or DummySound without a mixer
 
 # --- Colors ---
 COLOR_FLOOR = (50, 50, 50)
@@ -145,15 +159,47 @@ generator_tex_size = SCREEN_WIDTH // generator_grid_size
 last_generator_update = 0
 generator_update_interval = 0.1
 
+# --- Assets ---
+# Every generated asset, by parameters. Generation is seeded from the parameter hash, so output is identical across runs.
+FLOOR_TEXTURE = 20 # Texture ids for the floor and ceiling; never placed in a map
+CEILING_TEXTURE = 21
+TEXTURE_ASSETS = {
+    T_BRICK: ((150,50,50), (100,30,30), 'brick'), T_STONE: ((100,100,100), (70,70,70), 'stone'),
+    T_WOOD: ((180,120,80), (130,90,50), 'wood'), T_METAL: ((80,80,150), (50,50,100), 'metal'),
+    T_EXIT: ((0,0,50), (200,200,255), 'exit'),
+    FLOOR_TEXTURE: (COLOR_FLOOR, (35,35,35), 'stone'), CEILING_TEXTURE: (COLOR_CEILING, (55,55,95), 'wood'),
+}
+SPRITE_ASSETS = {10: (None, None, 'imp'), 11: (None, None, 'pickup_health'), 12: (None, None, 'demon'), 99: (None, COLOR_DARK_RED, 'dead_body')}
+SOUND_ASSETS = {
+    'shoot': dict(frequency=150,duration=0.15,volume=0.15,waveform='sawtooth',noise_factor=0.5,attack=0.005,decay=0.1,release=0.04),
+    'reload': dict(frequency=200,duration=0.4,volume=0.2,waveform='noise',noise_factor=0.3,attack=0.05,decay=0.3),
+    'no_ammo': dict(frequency=600,duration=0.08,volume=0.1,waveform='square',attack=0.01,decay=0.06),
+    'hit_wall': dict(frequency=800,duration=0.05,volume=0.1,waveform='noise',noise_factor=0.8,attack=0.002,decay=0.04),
+    'enemy_pain': dict(frequency=450,duration=0.2,volume=0.2,waveform='square',noise_factor=0.3,pitch_bend=-0.2),
+    'enemy_death': dict(frequency=150,duration=0.6,volume=0.25,waveform='noise',fm_freq=30,fm_amp=80,noise_factor=0.6),
+    'level_complete': dict(frequency=440,duration=1.0,volume=0.3,waveform='sine',attack=0.01,decay=0.8,fm_freq=5,fm_amp=20),
+    'pickup': dict(frequency=660,duration=0.2,volume=0.2,waveform='triangle',attack=0.01,decay=0.15),
+    'player_pain': dict(frequency=300,duration=0.3,volume=0.25,waveform='sine',pitch_bend=-0.5,noise_factor=0.1),
+}
+ASSET_VERSION = 1 # Bump when generation code changes so old cache entries are ignored
+ASSET_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.asset_cache')
+ASSET_POOL_MIN_JOBS = 32 # Spawning workers costs seconds while the 20 built-in assets generate inline in tens of ms, so the pool only runs for larger asset sets
+
 # --- Dummy Sound Class ---
 class DummySound:
     def play(self, *args, **kwargs): pass
     def stop(self, *args, **kwargs): pass
+    def pump(self): pass # Also stands in for a MusicStreamer
     def get_num_channels(self): return 0
 
 # --- Asset Generation ---
-def generate_texture(size, base_color, detail_color, pattern='brick'):
-    tex = pygame.Surface(size).convert()
+def _display_format(surface, alpha=False):
+    # Convert to the display's pixel format when there is one (asset workers have no display)
+    if not pygame.display.get_init() or pygame.display.get_surface() is None: return surface
+    return surface.convert_alpha() if alpha else surface.convert()
+
+def generate_texture(size, base_color, detail_color, pattern='brick', rng=random):
+    tex = _display_format(pygame.Surface(size))
     tex.fill(base_color)
     w, h = size
     if pattern == 'brick':
@@ -168,14 +214,14 @@ def generate_texture(size, base_color, detail_color, pattern='brick'):
                  pygame.draw.rect(tex, detail_color, (x, y, mortar, brick_h))
     elif pattern == 'stone':
         for _ in range(int(w * h * 0.05)):
-             spot_size=random.randint(w//16, w//8)
-             sx=random.randint(0,w-spot_size)
-             sy=random.randint(0,h-spot_size)
+             spot_size=rng.randint(w//16, w//8)
+             sx=rng.randint(0,w-spot_size)
+             sy=rng.randint(0,h-spot_size)
              pygame.draw.rect(tex, detail_color, (sx, sy, spot_size, spot_size), border_radius=2)
     elif pattern == 'wood':
         for i in range(w // 4):
-            x = i * 4 + random.randint(-5, 5)
-            pygame.draw.line(tex, detail_color, (x, 0), (x+random.randint(-2,2), h), 1)
+            x = i * 4 + rng.randint(-5, 5)
+            pygame.draw.line(tex, detail_color, (x, 0), (x+rng.randint(-2,2), h), 1)
     elif pattern == 'metal':
         panel_w = w // 4
         rivet_size = max(1, w // 32)
@@ -210,13 +256,13 @@ def generate_texture(size, base_color, detail_color, pattern='brick'):
         tex.fill(COLOR_DARK_GREY)
         splatter_color = detail_color if detail_color else COLOR_DARK_RED # Use detail_color for splatter
         for _ in range(5):
-            cx, cy = random.randint(w//4, 3*w//4), random.randint(h//4, 3*h//4)
-            r = random.randint(w//10, w//5)
+            cx, cy = rng.randint(w//4, 3*w//4), rng.randint(h//4, 3*h//4)
+            r = rng.randint(w//10, w//5)
             pygame.draw.circle(tex, splatter_color, (cx,cy), r)
     return tex
 
-def generate_alpha_texture(size, base_color, detail_color, pattern='imp'):
-    tex = pygame.Surface(size, pygame.SRCALPHA).convert_alpha(); tex.fill((0,0,0,0)); w,h=size
+def generate_alpha_texture(size, base_color, detail_color, pattern='imp', rng=random):
+    tex = _display_format(pygame.Surface(size, pygame.SRCALPHA), True); tex.fill((0,0,0,0)); w,h=size
     if pattern == 'imp':
         body,eye=COLOR_DARK_BROWN,COLOR_BRIGHT_RED
         pygame.draw.rect(tex, body, (w*0.3,h*0.4,w*0.4,h*0.5), border_radius=w//10)
@@ -238,23 +284,24 @@ def generate_alpha_texture(size, base_color, detail_color, pattern='imp'):
         splat=detail_color if detail_color else COLOR_DARK_RED # Use provided detail or default
         pygame.draw.ellipse(tex, body, (w*0.2,h*0.3,w*0.6,h*0.4))
         for _ in range(5):
-            cx,cy=random.randint(w//4,3*w//4),random.randint(h//4,3*h//4)
-            r=random.randint(w//10,w//5)
+            cx,cy=rng.randint(w//4,3*w//4),rng.randint(h//4,3*h//4)
+            r=rng.randint(w//10,w//5)
             pygame.draw.circle(tex, splat, (cx,cy), r)
     return tex
 
-def generate_sound(frequency=440, duration=0.1, attack=0.01, decay=0.05, sustain_level=0.1, release=0.02,
-                   volume=0.1, waveform='sine', noise_factor=0.0, pitch_bend=0.0, fm_freq=0.0, fm_amp=0.0):
+def synth_wave(frequency=440, duration=0.1, attack=0.01, decay=0.05, sustain_level=0.1, release=0.02,
+               volume=0.1, waveform='sine', noise_factor=0.0, pitch_bend=0.0, fm_freq=0.0, fm_amp=0.0, rng=np.random):
+    # Samples as an int16 array shaped for the mixer, or None for an empty sound
     num_samples = int(duration * SAMPLE_RATE);
-    if num_samples <= 0: return DummySound()
+    if num_samples <= 0: return None
     t=np.linspace(0,duration,num_samples,endpoint=False); mod=fm_amp*np.sin(fm_freq*2*np.pi*t) if fm_freq>0 else 0
     freq=frequency*(1+pitch_bend*(t/duration))+mod; freq=np.maximum(20,freq); phase=np.cumsum(freq*2*np.pi/SAMPLE_RATE)
     wave=np.sin(phase)
     if waveform=='square': wave=np.sign(np.sin(phase))
     elif waveform=='sawtooth': wave=2*(phase/(2*np.pi)%1)-1
     elif waveform=='triangle': wave=2*np.abs(2*(phase/(2*np.pi)%1)-1)-1
-    elif waveform=='noise': wave=np.random.uniform(-1,1,num_samples)
-    if noise_factor>0: noise=np.random.uniform(-1,1,num_samples)*noise_factor; wave=np.clip(wave*(1-noise_factor)+noise,-1,1)
+    elif waveform=='noise': wave=rng.uniform(-1,1,num_samples)
+    if noise_factor>0: noise=rng.uniform(-1,1,num_samples)*noise_factor; wave=np.clip(wave*(1-noise_factor)+noise,-1,1)
     a,d,r=max(1,int(attack*SAMPLE_RATE)),max(1,int(decay*SAMPLE_RATE)),max(1,int(release*SAMPLE_RATE))
     total_len=a+d+r
     if total_len>num_samples and total_len>0: scale=num_samples/total_len; a=max(1,int(a*scale)); d=max(1,int(d*scale)); r=max(1,num_samples-a-d)
@@ -272,22 +319,558 @@ def generate_sound(frequency=440, duration=0.1, attack=0.01, decay=0.05, sustain
     if AUDIO_CHANNELS==2:
         if sound_data.ndim==1: sound_data=np.column_stack((sound_data,sound_data))
         elif sound_data.shape[1]==1: sound_data=np.column_stack((sound_data[:,0],sound_data[:,0]))
+    return np.ascontiguousarray(sound_data)
+
+def make_sound(sound_data):
+    if sound_data is None: return DummySound()
     try: return pygame.sndarray.make_sound(np.ascontiguousarray(sound_data))
     except Exception as e: print(f"Error making sound: {e}"); return DummySound()
 
+def generate_sound(*args, rng=np.random, **params): return make_sound(synth_wave(*args,rng=rng,**params))
+
+# --- Music ---
+# A track is looped step patterns: semitones from root per step (None rests), one pattern per voice, each voice a synth_wave preset.
+MUSIC_TRACKS = {
+    'level1_music': dict(bpm=132, step=0.5, root=110.0, voices=[
+        ([0,None,0,12,None,10,7,None, 3,None,3,15,None,12,10,7], dict(waveform='square',volume=0.05,attack=0.005,decay=0.08,sustain_level=0.4,release=0.05)),
+        ([-12,-12,-12,-12,-12,-12,-12,-12, -9,-9,-9,-9,-14,-14,-14,-14], dict(waveform='triangle',volume=0.12,attack=0.01,decay=0.1,sustain_level=0.6,release=0.05))]),
+    'level2_music': dict(bpm=100, step=0.5, root=98.0, voices=[
+        ([0,3,7,3,10,7,3,None, 0,3,8,3,12,8,3,None], dict(waveform='sawtooth',volume=0.04,attack=0.01,decay=0.1,sustain_level=0.3,release=0.08,fm_freq=6,fm_amp=3)),
+        ([-12,None,-12,None,-16,None,-16,None], dict(waveform='sine',volume=0.15,attack=0.01,decay=0.2,sustain_level=0.5,release=0.1))]),
+}
+MUSIC_BLOCK = 0.1 # Seconds of audio per queued block
+MUSIC_QUEUE_BLOCKS = 4 # Blocks synthesized ahead; bounds both memory and how far the synth runs ahead of playback
+
+def music_track(key):
+    # Named track, or for any other key a minor-pentatonic track generated from the key itself
+    if key in MUSIC_TRACKS: return MUSIC_TRACKS[key]
+    rng=random.Random(asset_key('music',key)); scale=[0,3,5,7,10,12,15]
+    return dict(bpm=rng.choice((96,112,128)),step=0.5,root=rng.choice((98.0,110.0,123.5)),voices=[
+        ([rng.choice(scale+[None]) for _ in range(16)],dict(waveform=rng.choice(('square','triangle')),volume=0.05,attack=0.005,decay=0.08,sustain_level=0.4,release=0.05)),
+        ([rng.choice((-12,-9,-7)) for _ in range(4) for _ in range(4)],dict(waveform='triangle',volume=0.12,attack=0.01,decay=0.1,sustain_level=0.6,release=0.05))])
+
+class MusicStreamer:
+    # Plays a track on a reserved mixer channel without ever synthesizing more than MUSIC_QUEUE_BLOCKS ahead.
+    # A daemon thread renders it step by step with synth_wave into a bounded queue of MUSIC_BLOCK blocks;
+    # pump(), called every frame, hands finished blocks to Channel.queue and never waits for the synth.
+    def __init__(self, channel, track, seed=0):
+        self.channel,self.blocks,self.stopped=channel,queue.Queue(MUSIC_QUEUE_BLOCKS),threading.Event()
+        self.thread=threading.Thread(target=self._run,args=(track,seed),name='music',daemon=True); self.thread.start()
+
+    @staticmethod
+    def steps(track, rng):
+        # Endless mixed samples, one step of every voice at a time
+        dur=60.0/track['bpm']*track['step']; n=int(dur*SAMPLE_RATE); k=0
+        while True:
+            mix=np.zeros((n,AUDIO_CHANNELS) if AUDIO_CHANNELS==2 else n,dtype=np.int32)
+            for pattern,voice in track['voices']:
+                note=pattern[k%len(pattern)]
+                if note is not None: mix+=synth_wave(track['root']*2**(note/12),dur,rng=rng,**voice)[:n]
+            yield np.clip(mix,-32768,32767).astype(np.int16); k+=1
+
+    def _run(self, track, seed):
+        size=int(MUSIC_BLOCK*SAMPLE_RATE); pending=[]; have=0
+        for samples in self.steps(track,np.random.default_rng(seed)):
+            pending.append(samples); have+=len(samples)
+            if have<size: continue
+            data=np.concatenate(pending); cut=len(data)-len(data)%size; pending=[data[cut:]]; have=len(data)-cut
+            for block in np.split(data[:cut],cut//size):
+                while not self.stopped.is_set():
+                    try: self.blocks.put(block,timeout=0.1); break
+                    except queue.Full: pass
+            if self.stopped.is_set(): return
+
+    def pump(self):
+        # Keeps the channel playing with one block queued behind the current one
+        while self.channel.get_queue() is None:
+            try: block=self.blocks.get_nowait()
+            except queue.Empty: return
+            sound=make_sound(block)
+            if self.channel.get_busy(): self.channel.queue(sound)
+            else: self.channel.play(sound)
+
+    def stop(self):
+        self.stopped.set(); self.channel.stop(); self.thread.join(1.0)
+
+# --- Level Grid ---
+GRID_PAD = 1 # Ring of T_BRICK around every level, so a lookup up to a tile off the map needs no bounds check
+
+class LevelGrid:
+    # A level's tiles as a padded uint8 array plus one boolean mask per collision question, all indexed [y, x].
+    # World tile (x, y) is tiles[y+GRID_PAD, x+GRID_PAD]; the queries take world coordinates (scalars or arrays)
+    # and clamp anything further out onto the padding, which is opaque and solid.
+    def __init__(self, rows):
+        P=GRID_PAD; rows=np.asarray(rows,dtype=np.uint8); self.height,self.width=rows.shape
+        self.tiles=np.full((self.height+2*P,self.width+2*P),T_BRICK,dtype=np.uint8); self.tiles[P:P+self.height,P:P+self.width]=rows
+        self.view=self.tiles[P:P+self.height,P:P+self.width] # Unpadded, for code that walks the map itself
+        self.opaque,self.exit,self.solid,self.walkable=self._masks(self.tiles); self.watchers=[]; self.version=0 # Bumped by every set_tile
+
+    @staticmethod
+    def _masks(tiles):
+        opaque=tiles>T_EMPTY # Stops view rays; the exit is drawn as a wall
+        exit_=tiles==T_EXIT
+        solid=opaque&~exit_ # Stops movement and shots
+        walkable=tiles==T_EMPTY # Where sprites and knockback may land
+        return opaque,exit_,solid,walkable
+
+    def _index(self, x, y):
+        P=GRID_PAD; h,w=self.tiles.shape
+        return np.clip(np.floor(y).astype(np.intp)+P,0,h-1),np.clip(np.floor(x).astype(np.intp)+P,0,w-1)
+
+    def tile_at(self, x, y): return self.tiles[self._index(x,y)]
+    def is_solid(self, x, y): return self.solid[self._index(x,y)]
+    def is_walkable(self, x, y): return self.walkable[self._index(x,y)]
+    def is_exit(self, x, y): return self.exit[self._index(x,y)]
+
+    def slide(self, x, y, dx, dy):
+        # Moves by (dx, dy) unless that ends inside a solid tile, else along each axis on its own (x first) so movers slide along walls
+        nx,ny=x+dx,y+dy; free=~self.is_solid(nx,ny)
+        sx=np.where(free|~self.is_solid(nx,y),nx,x); sy=np.where(free|~self.is_solid(sx,ny),ny,y)
+        return sx,sy
+
+    def set_tile(self, x, y, tile):
+        # Changes one map tile, keeps the masks in step and tells watchers (called as fn(x, y)) about it
+        P=GRID_PAD; self.tiles[y+P,x+P]=tile
+        for mask,v in zip((self.opaque,self.exit,self.solid,self.walkable),self._masks(np.uint8(tile))): mask[y+P,x+P]=v
+        self.version+=1
+        for fn in self.watchers: fn(x,y)
+
+    def strips(self, rows=64):
+        # Yields (y0, tiles) for the unpadded map in full-width strips of rows rows (one chunk row at the default LEVEL_CHUNK),
+        # so a scan of a ChunkedGrid only needs one strip's chunks resident instead of pulling the whole map in like view
+        for y0 in range(0,self.height,rows): yield y0,self.window(0,y0,self.width,y0+rows)
+
+    def window(self, x0, y0, x1, y1):
+        # Unpadded tiles of the rectangle [x0, x1) x [y0, y1), clipped to the map
+        x0,y0,x1,y1=max(x0,0),max(y0,0),min(x1,self.width),min(y1,self.height); P=GRID_PAD
+        ys,xs=np.mgrid[y0+P:max(y0,y1)+P,x0+P:max(x0,x1)+P]; return self.tiles[ys,xs]
+
+CHUNK_POOL_SIZE = 1024 # Resident chunks of a ChunkedGrid (64x64 chunks: 4 MB); grows only if a single query needs more
+
+class ChunkedGrid(LevelGrid):
+    # LevelGrid over a level file's memory-mapped tiles, for maps too large to load up front. A chunk is copied into
+    # a fixed pool the first time a query touches it and the least recently used one makes room, so resident memory
+    # follows what rays and movers actually reach. tiles and the masks are _ChunkLayer views taking [ys, xs] arrays.
+    # Lookups and edits hold a lock, since render bands raycast from several threads at once.
+    def __init__(self, path, header, capacity=CHUNK_POOL_SIZE):
+        self.width,self.height,C=int(header['width']),int(header['height']),int(header['chunk']); self.chunk=C
+        ncy,ncx=-(-self.height//C),-(-self.width//C); self.chunks=np.memmap(path,np.uint8,'r',int(header['grid_offset']),(ncy*ncx,C,C))
+        self.slot_of=np.full(ncy*ncx,-1,dtype=np.intp); self.owner=np.full(capacity,-1,dtype=np.intp)
+        self.last_used=np.zeros(capacity,dtype=np.int64); self.clock=0; self.pool=np.empty((capacity,C,C),dtype=np.uint8); self.chunks_x=ncx
+        self.edits={}; self.watchers=[]; self.version=0; self.lock=threading.Lock() # Chunk id -> {(y, x) in chunk: tile} written over the file's tiles whenever the chunk loads
+        luts=self._masks(np.arange(256,dtype=np.uint8)); self.tiles=_ChunkLayer(self)
+        self.opaque,self.exit,self.solid,self.walkable=(_ChunkLayer(self,lut) for lut in luts)
+
+    @property
+    def view(self):
+        # Whole map; reads every chunk, so only for small maps or tools
+        return self.window(0,0,self.width,self.height)
+
+    def lookup(self, ys, xs):
+        # Tiles at padded coordinates; anything off the map reads as the T_BRICK padding
+        P,C=GRID_PAD,self.chunk; ys,xs=np.broadcast_arrays(np.asarray(ys)-P,np.asarray(xs)-P)
+        out=np.full(np.shape(ys),T_BRICK,dtype=np.uint8); inside=(xs>=0)&(xs<self.width)&(ys>=0)&(ys<self.height)
+        y,x=ys[inside],xs[inside]; ids=(y//C)*self.chunks_x+x//C
+        with self.lock:
+            self.clock+=1; slots=self.slot_of[ids]
+            self.last_used[slots[slots>=0]]=self.clock # Before loading, so the chunks this query hits aren't evicted for its misses
+            if (slots<0).any(): self._load(np.unique(ids[slots<0])); slots=self.slot_of[ids]
+            self.last_used[slots]=self.clock; out[inside]=self.pool[slots,y%C,x%C]
+        return out[()]
+
+    def _load(self, ids):
+        # Caller holds the lock
+        free=np.flatnonzero(self.owner<0)
+        if len(free)<len(ids): # Evict the least recently used chunks not touched by this query
+            used=np.flatnonzero((self.owner>=0)&(self.last_used<self.clock)); used=used[np.argsort(self.last_used[used])][:len(ids)-len(free)]
+            self.slot_of[self.owner[used]]=-1; self.owner[used]=-1; free=np.concatenate((free,used))
+        if len(free)<len(ids):
+            grow=len(ids)-len(free); n=len(self.owner); free=np.concatenate((free,np.arange(n,n+grow)))
+            self.owner=np.concatenate((self.owner,np.full(grow,-1))); self.last_used=np.concatenate((self.last_used,np.zeros(grow,dtype=np.int64)))
+            self.pool=np.concatenate((self.pool,np.empty((grow,)+self.pool.shape[1:],dtype=np.uint8)))
+        slots=free[:len(ids)]; self.pool[slots]=self.chunks[ids]; self.owner[slots]=ids; self.slot_of[ids]=slots
+        for slot,i in zip(slots.tolist(),ids.tolist()):
+            for (ly,lx),tile in self.edits.get(i,{}).items(): self.pool[slot,ly,lx]=tile
+
+    def set_tile(self, x, y, tile):
+        C=self.chunk; i=(y//C)*self.chunks_x+x//C
+        with self.lock:
+            self.edits.setdefault(i,{})[(y%C,x%C)]=tile
+            if self.slot_of[i]>=0: self.pool[self.slot_of[i],y%C,x%C]=tile
+            self.version+=1
+        for fn in self.watchers: fn(x,y)
+
+    def resident(self): return int((self.owner>=0).sum())
+
+class _ChunkLayer:
+    # Index-only stand-in for one of LevelGrid's padded arrays: layer[ys, xs] looks the tiles up and maps them through lut
+    def __init__(self, grid, lut=None): self.grid,self.lut=grid,lut
+
+    @property
+    def shape(self): return self.grid.height+2*GRID_PAD,self.grid.width+2*GRID_PAD
+
+    def __getitem__(self, key):
+        tiles=self.grid.lookup(*key); return tiles if self.lut is None else self.lut[tiles]
+
+# --- Level Files ---
+# Binary level: header, sprite table, UTF-8 music key, then the tile grid from grid_offset on as chunk x chunk blocks in
+# row-major chunk order, so a chunk is one contiguous run (one page at the default size) that memmap can fault in alone.
+LEVEL_MAGIC = b'RCLV'
+LEVEL_VERSION = 1
+LEVEL_CHUNK = 64
+LEVEL_ALIGN = 4096
+LEVEL_HEADER = np.dtype([('magic','S4'),('version','<u2'),('chunk','<u2'),('width','<u4'),('height','<u4'),('start_x','<f4'),('start_y','<f4'),
+                         ('angle','<f4'),('sprite_count','<u4'),('music_len','<u4'),('grid_offset','<u8')])
+LEVEL_SPRITE = np.dtype([('x','<f4'),('y','<f4'),('texture_index','<i2'),('scale','<f4'),('static','u1'),('health','<i4')])
+
+def sprite_table(sprites):
+    # LEVEL_SPRITE table from a LEVELS sprite list, filling in SpriteWorld.add's defaults; tables pass through
+    if isinstance(sprites,np.ndarray): return sprites
+    return np.array([(*sd,*(1.0,True,30)[len(sd)-3:]) for sd in sprites],dtype=LEVEL_SPRITE)
+
+def write_level_file(path, level, chunk=LEVEL_CHUNK):
+    tiles=np.asarray(level["map"],dtype=np.uint8); h,w=tiles.shape; ncy,ncx=-(-h//chunk),-(-w//chunk)
+    music=level.get("music","").encode(); table=sprite_table(level["sprites"])
+    offset=-(-(LEVEL_HEADER.itemsize+table.nbytes+len(music))//LEVEL_ALIGN)*LEVEL_ALIGN
+    header=np.array([(LEVEL_MAGIC,LEVEL_VERSION,chunk,w,h,*level["player_start"],level["player_angle"],len(table),len(music),offset)],dtype=LEVEL_HEADER)
+    grid=np.full((ncy*chunk,ncx*chunk),T_BRICK,dtype=np.uint8); grid[:h,:w]=tiles
+    with open(path,'wb') as f:
+        f.write(header.tobytes()); f.write(table.tobytes()); f.write(music); f.write(bytes(offset-f.tell()))
+        f.write(grid.reshape(ncy,chunk,ncx,chunk).transpose(0,2,1,3).tobytes())
+
+def read_level_file(path):
+    # Level dict like a LEVELS entry; the map is a ChunkedGrid, so no tiles are read yet
+    with open(path,'rb') as f:
+        header=np.frombuffer(f.read(LEVEL_HEADER.itemsize),dtype=LEVEL_HEADER)
+        if len(header)!=1 or header[0]['magic']!=LEVEL_MAGIC: raise ValueError(f"{path} is not a level file")
+        header=header[0]
+        if header['version']!=LEVEL_VERSION: raise ValueError(f"{path}: unsupported level version {header['version']}")
+        table=np.frombuffer(f.read(LEVEL_SPRITE.itemsize*int(header['sprite_count'])),dtype=LEVEL_SPRITE); music=f.read(int(header['music_len'])).decode()
+    return {"map":ChunkedGrid(path,header),"player_start":(float(header['start_x']),float(header['start_y'])),"player_angle":float(header['angle']),
+            "sprites":table,"music":music}
+
+def generate_level(width, height, seed=0, density=0.2):
+    # Random wall tiles inside a brick border with an exit in the far corner, for exercising large maps
+    rng=np.random.default_rng(seed); tiles=np.where(rng.random((height,width))<density,rng.integers(T_BRICK,T_METAL+1,(height,width)),T_EMPTY).astype(np.uint8)
+    tiles[[0,-1],:]=T_BRICK; tiles[:,[0,-1]]=T_BRICK; tiles[1:3,1:3]=T_EMPTY; tiles[-3:-1,-3:-1]=T_EMPTY; tiles[-2,-2]=T_EXIT
+    ys,xs=np.nonzero(tiles==T_EMPTY); pick=rng.choice(len(xs),min(len(xs),width*height//256),replace=False); kinds=rng.choice([10,12,11],len(pick),p=[0.6,0.2,0.2])
+    sprites=[(xs[k]+0.5,ys[k]+0.5,int(t),{10:1.0,12:1.2,11:0.5}[t],bool(t==11),{10:40,12:80,11:1}[t]) for k,t in zip(pick,kinds)]
+    return {"map":tiles,"player_start":(1.5,1.5),"player_angle":0.0,"sprites":sprites,"music":"generated"}
+
+# --- Raycasting ---
+def _dda(px, py, rdx, rdy, blocking, max_steps=None, on_step=None):
+    # Batched grid DDA in array coordinates: every ray steps in lockstep until it enters a blocking cell, or for at most max_steps.
+    # blocking must have a blocking border around the origins (a LevelGrid mask), so no ray can step outside it, and is
+    # only indexed at the cells rays enter, so a ChunkedGrid layer only loads chunks along the rays.
+    # on_step(mx, my), if given, sees the cells entered by the still-active rays after every step.
+    n=rdx.shape[0]
+    px=np.broadcast_to(np.asarray(px,dtype=float),(n,)); py=np.broadcast_to(np.asarray(py,dtype=float),(n,))
+    mx,my=np.floor(px).astype(np.intp),np.floor(py).astype(np.intp)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        ddx=np.where(rdx!=0,np.abs(1/rdx),np.inf); ddy=np.where(rdy!=0,np.abs(1/rdy),np.inf)
+        sx=np.where(rdx<0,-1,1); sdx=np.where(rdx<0,(px-mx)*ddx,(mx+1.0-px)*ddx)
+        sy=np.where(rdy<0,-1,1); sdy=np.where(rdy<0,(py-my)*ddy,(my+1.0-py)*ddy)
+    side=np.zeros(n,dtype=np.int8); steps=np.zeros(n,dtype=np.intp); hit=np.zeros(n,dtype=bool); active=np.ones(n,dtype=bool)
+    k=0
+    while active.any() and (max_steps is None or k<max_steps):
+        xs=active&(sdx<sdy); ys=active&~xs; k+=1
+        sdx=np.where(xs,sdx+ddx,sdx); mx=np.where(xs,mx+sx,mx); sdy=np.where(ys,sdy+ddy,sdy); my=np.where(ys,my+sy,my)
+        side[xs]=0; side[ys]=1; steps+=active
+        a=np.flatnonzero(active)
+        if on_step: on_step(mx[a],my[a])
+        a=a[blocking[my[a],mx[a]]]; hit[a]=True; active[a]=False
+    return mx,my,side,hit,steps
+
+def _hit_distance(px, py, rdx, rdy, mx, my, side):
+    # Distance to the entered cell's face in units of the ray direction (perpendicular distance for camera rays)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return np.where(side==0,(mx-px+(1-np.where(rdx<0,-1,1))/2)/rdx,(my-py+(1-np.where(rdy<0,-1,1))/2)/rdy)
+
+def _reuse_fan(fan, theta):
+    # Cell and side for rays at angles theta that fall between two rays of fan (a previous frame's rays from the same
+    # point) which hit the same face of the same tile: a ray between them must hit that face too, as the sliver they
+    # bound is under a tile wide and any tile poking into it would have stopped one of them. Returns mx, my, side, ok.
+    ftheta,fmx,fmy,fside,fhit=fan; ref=ftheta[len(ftheta)//2]; rel=lambda t:(t-ref+math.pi)%(2*math.pi)-math.pi # Angles about the fan's centre
+    phi=rel(ftheta); order=np.argsort(phi,kind='stable'); phi=phi[order]; q=rel(theta); j=np.clip(np.searchsorted(phi,q),1,len(phi)-1); a,b=order[j-1],order[j]
+    ok=(phi[j-1]<=q)&(q<=phi[j])&fhit[a]&fhit[b]&(fmx[a]==fmx[b])&(fmy[a]==fmy[b])&(fside[a]==fside[b])
+    return fmx[a],fmy[a],fside[a],ok
+
+def cast_walls(px, py, angle, depth_buffer, width=SCREEN_WIDTH, height=SCREEN_HEIGHT, x0=0, fan=None):
+    # One ray per screen column from x0 on, as many as depth_buffer holds. With fan, the rays returned by an earlier
+    # call from the same point on the same map, columns that _reuse_fan can resolve skip the DDA.
+    # Fills depth_buffer and returns per-column tile, texture column, line height and shade, and the rays for a later fan
+    dirX,dirY=math.cos(angle),math.sin(angle); planeX,planeY=math.sin(angle)*0.66,-math.cos(angle)*0.66
+    cam=2*np.arange(x0,x0+len(depth_buffer))/width-1; rdx,rdy=dirX+planeX*cam,dirY+planeY*cam; theta=np.arctan2(rdy,rdx)
+    gx,gy=px+GRID_PAD,py+GRID_PAD
+    if fan is None: mx,my,side,hit,_=_dda(gx,gy,rdx,rdy,MAP_GRID.opaque)
+    else:
+        mx,my,side,hit=_reuse_fan(fan,theta); cast=np.flatnonzero(~hit)
+        if len(cast): mx[cast],my[cast],side[cast],hit[cast],_=_dda(gx,gy,rdx[cast],rdy[cast],MAP_GRID.opaque)
+    pwd=_hit_distance(gx,gy,rdx,rdy,mx,my,side); pwd[~hit]=np.inf; pwd[~(pwd>1e-4)]=np.inf # Also catches NaN
+    with np.errstate(invalid='ignore'):
+        wx=np.where(side==0,py+pwd*rdy,px+pwd*rdx); wx-=np.floor(wx)
+        tex_x=np.where(np.isfinite(wx),wx*TEX_WIDTH,0).astype(np.intp)
+        line_h=(height/pwd).astype(np.intp)
+    tex_x=np.where(((side==0)&(rdx>0))|((side==1)&(rdy<0)),TEX_WIDTH-tex_x-1,tex_x); np.clip(tex_x,0,TEX_WIDTH-1,out=tex_x)
+    tiles=np.where(hit,MAP_GRID.tiles[my,mx],T_BRICK)
+    shade=np.clip(1.0/(1+pwd*0.1),0.2,1.0)*np.where(side==1,0.7,1.0)
+    depth_buffer[:]=pwd
+    return tiles,tex_x,line_h,shade,(theta,mx,my,side,hit)
+
+# --- Visibility ---
+PVS_RADIUS = 32 # Tiles; the sets cover this window around each tile and anything beyond it always counts as visible
+PVS_RAYS = 1536 # Ray directions per source point
+PVS_SOURCES = 5 # Source points per side of the source tile, corners included, so PVS_SOURCES^2 in all
+
+class VisibilitySets:
+    # Potentially visible set per tile: a bitset over the (2*radius+1)^2 tiles around it, a superset of the tiles any
+    # point of it can see. Rays from a grid of source points walk the tiles and mark everything within `slack` of their
+    # path; a ray stops only on entering the opaque area eroded by slack. Any clear sight line from the tile stays within
+    # slack of one of these rays all the way (slack covers the source spacing plus the angular spacing at the window's
+    # far corner), so that ray cannot stop before it has marked everything the sight line reaches. The sets are dilated
+    # by a tile so sprites overlapping a visible tile count. A set takes a good fraction of a frame to build, so visible()
+    # queues it for a worker thread the first time a tile is asked about and culls nothing from that tile until it is
+    # ready; sets are dropped when a tile they include changes.
+    def __init__(self, grid, radius=PVS_RADIUS):
+        self.grid,self.radius,self.sets=grid,radius,{}; grid.watchers.append(self.invalidate)
+        src=np.linspace(0,1,PVS_SOURCES); ang=np.linspace(0,2*np.pi,PVS_RAYS,endpoint=False); self.reach=(radius+1)*math.sqrt(2)
+        self.slack=math.sqrt(0.5)/(PVS_SOURCES-1)+self.reach*math.pi/PVS_RAYS # Under half a tile, so a one-tile wall still blocks
+        ox,oy,a=np.meshgrid(src,src,ang); self.ox,self.oy,self.rdx,self.rdy=ox.ravel(),oy.ravel(),np.cos(a).ravel(),np.sin(a).ravel(); self._last=(None,None)
+        self.lock=threading.Lock(); self.pending=set(); self.epoch=0 # Bumped by invalidate, so a set built from the old map is discarded
+        self.pool=concurrent.futures.ThreadPoolExecutor(1,thread_name_prefix='pvs')
+
+    def close(self):
+        self.pool.shutdown(wait=False,cancel_futures=True)
+        if self.invalidate in self.grid.watchers: self.grid.watchers.remove(self.invalidate)
+
+    def _eroded(self, tx, ty, m):
+        # Per tile of the window grown by m, the part of it whose slack-square is all opaque, as a box in tile-local
+        # coordinates (empty for open tiles); the notch an open diagonal leaves between two opaque neighbours is cut off the x extent
+        r,P,sl=self.radius,GRID_PAD,self.slack; ys,xs=np.mgrid[ty-r-m-1:ty+r+m+2,tx-r-m-1:tx+r+m+2]
+        h,w=self.grid.opaque.shape; op=self.grid.opaque[np.clip(ys+P,0,h-1),np.clip(xs+P,0,w-1)]; c=op[1:-1,1:-1]; L,R,U,D=~op[1:-1,:-2],~op[1:-1,2:],~op[:-2,1:-1],~op[2:,1:-1]
+        x0,x1,y0,y1=np.where(L,sl,0.0),np.where(R,1-sl,1.0),np.where(U,sl,0.0),np.where(D,1-sl,1.0)
+        x0=np.where(~L&((~U&~op[:-2,:-2])|(~D&~op[2:,:-2])),np.maximum(x0,sl),x0); x1=np.where(~R&((~U&~op[:-2,2:])|(~D&~op[2:,2:])),np.minimum(x1,1-sl),x1)
+        return np.where(c,x0,1.0),np.where(c,x1,0.0),np.where(c,y0,1.0),np.where(c,y1,0.0)
+
+    def _compute(self, tx, ty):
+        r,sl=self.radius,self.slack; n=2*r+1; m=2; seen=np.zeros((n+2*m,n+2*m),dtype=bool) # Margin for marks and the dilation
+        ex0,ex1,ey0,ey1=self._eroded(tx,ty,m); o=r+m # Window index of tile (tx, ty)
+        ox,oy,rdx,rdy=tx+self.ox,ty+self.oy,self.rdx,self.rdy; mx,my=np.floor(ox).astype(np.intp),np.floor(oy).astype(np.intp)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            ddx,ddy=np.where(rdx!=0,np.abs(1/rdx),np.inf),np.where(rdy!=0,np.abs(1/rdy),np.inf); sx,sy=np.where(rdx<0,-1,1),np.where(rdy<0,-1,1)
+            sdx=np.where(rdx<0,ox-mx,mx+1.0-ox)*ddx; sdy=np.where(rdy<0,oy-my,my+1.0-oy)*ddy; sdx[rdx==0]=np.inf; sdy[rdy==0]=np.inf
+        t0=np.zeros(len(ox)); a=np.arange(len(ox))
+        while len(a):
+            t1=np.minimum(np.minimum(sdx[a],sdy[a]),self.reach); cx,cy=mx[a],my[a]; lx,ly=cx-tx+o,cy-ty+o
+            inside=(lx>=1)&(lx<n+2*m-1)&(ly>=1)&(ly<n+2*m-1); a,t1,cx,cy,lx,ly,ta=a[inside],t1[inside],cx[inside],cy[inside],lx[inside],ly[inside],t0[a][inside]
+            xa,xb=ox[a]+rdx[a]*ta-cx,ox[a]+rdx[a]*t1-cx; ya,yb=oy[a]+rdy[a]*ta-cy,oy[a]+rdy[a]*t1-cy # The ray's stretch through this tile
+            xlo,xhi,ylo,yhi=np.minimum(xa,xb),np.maximum(xa,xb),np.minimum(ya,yb),np.maximum(ya,yb)
+            for dy,ny in ((-1,ylo<sl),(0,True),(1,yhi>1-sl)):
+                for dx,nx in ((-1,xlo<sl),(0,True),(1,xhi>1-sl)): sel=nx&ny; seen[ly[sel]+dy,lx[sel]+dx]=True
+            e=(ly,lx); bx0,bx1,by0,by1=ex0[e],ex1[e],ey0[e],ey1[e] # Slab test of the stretch against the tile's eroded box
+            with np.errstate(divide='ignore',invalid='ignore'):
+                qx0,qx1=(bx0+cx-ox[a])/rdx[a],(bx1+cx-ox[a])/rdx[a]; qy0,qy1=(by0+cy-oy[a])/rdy[a],(by1+cy-oy[a])/rdy[a]
+                lo=np.maximum.reduce([ta,np.where(rdx[a]!=0,np.minimum(qx0,qx1),np.where((xa>=bx0)&(xa<=bx1),-np.inf,np.inf)),np.where(rdy[a]!=0,np.minimum(qy0,qy1),np.where((ya>=by0)&(ya<=by1),-np.inf,np.inf))])
+                hi=np.minimum.reduce([t1,np.where(rdx[a]!=0,np.maximum(qx0,qx1),np.inf),np.where(rdy[a]!=0,np.maximum(qy0,qy1),np.inf)])
+            go=~((bx0<bx1)&(by0<by1)&(lo<=hi))&(t1<self.reach); a=a[go]
+            xs=sdx[a]<sdy[a]; ys=~xs; b=a[xs]; t0[b]=sdx[b]; sdx[b]+=ddx[b]; mx[b]+=sx[b]; b=a[ys]; t0[b]=sdy[b]; sdy[b]+=ddy[b]; my[b]+=sy[b]
+        near=seen.copy(); k=n+2*m
+        for dy in (-1,0,1):
+            for dx in (-1,0,1): near[1:-1,1:-1]|=seen[1+dy:k-1+dy,1+dx:k-1+dx]
+        return np.packbits(near[m:m+n,m:m+n])
+
+    def _build(self, key, epoch):
+        bits=self._compute(*key)
+        with self.lock:
+            if self.epoch==epoch: self.sets[key]=bits
+            self.pending.discard(key)
+
+    def bits(self, tx, ty, wait=True):
+        # Packed set of tile (tx, ty), built here on first use; with wait=False queued for the worker instead (None until ready)
+        key=(tx,ty)
+        with self.lock:
+            bits=self.sets.get(key); epoch=self.epoch
+            if bits is not None or not wait:
+                if bits is None and key not in self.pending: self.pending.add(key); self.pool.submit(self._build,key,epoch)
+                return bits
+        bits=self._compute(tx,ty)
+        with self.lock:
+            if self.epoch==epoch: self.sets[key]=bits
+        return bits
+
+    def mask(self, tx, ty, wait=True):
+        # Unpacked set of tile (tx, ty), indexed [y-ty+radius, x-tx+radius]
+        if self._last[0]==(tx,ty): return self._last[1]
+        bits=self.bits(tx,ty,wait)
+        if bits is None: return None
+        n=2*self.radius+1; m=np.unpackbits(bits,count=n*n).astype(bool).reshape(n,n); self._last=((tx,ty),m); return m
+
+    def visible(self, px, py, xs, ys):
+        # Which of the points (xs, ys) lie in tiles potentially visible from the tile holding (px, py); those outside the
+        # window all do, as do all of them while that tile's set is still being built
+        tx,ty=math.floor(px),math.floor(py); r=self.radius; m=self.mask(tx,ty,wait=False)
+        if m is None: return np.ones(np.shape(xs),dtype=bool)
+        lx,ly=np.floor(xs).astype(np.intp)-tx+r,np.floor(ys).astype(np.intp)-ty+r; inside=(lx>=0)&(lx<=2*r)&(ly>=0)&(ly<=2*r)
+        ok=~inside; ok[inside]=m[ly[inside],lx[inside]]; return ok
+
+    def invalidate(self, x, y):
+        # Map tile (x, y) changed: drop every set that contains it, as only those tiles had a line of sight through it
+        r=self.radius; self._last=(None,None)
+        with self.lock:
+            self.epoch+=1
+            for (tx,ty),bits in list(self.sets.items()):
+                lx,ly=x-tx+r,y-ty+r
+                if 0<=lx<=2*r and 0<=ly<=2*r and bits[(ly*(2*r+1)+lx)>>3]&(0x80>>((ly*(2*r+1)+lx)&7)): del self.sets[(tx,ty)]
+
+# --- Navigation ---
+FLOW_RADIUS = 16 # Tiles; enemies further than this (along paths) from the player's tile fall back to heading straight at them
+FLOW_UNREACHED = np.iinfo(np.int16).max
+FLOW_WAKE_STEPS = 12 # Enemies out of the player's PVS still move while their path to the player is at most this many steps
+FLOW_STEPS = ((1,0), (-1,0), (0,1), (0,-1), (1,1), (1,-1), (-1,1), (-1,-1)) # Neighbour offsets; orthogonal first so ties stay straight
+
+class FlowField:
+    # Breadth-first distance over walkable tiles from the player's tile, within radius tiles of it, shared by every enemy.
+    # Each tile also keeps the neighbour one step nearer (diagonals only when neither corner is blocked), so an enemy
+    # follows the field with one lookup however many there are. Holds one field per viewpoint, rows of (N, n, n) arrays
+    # (the game has one, BatchedEnv one per instance); a row is rebuilt only when its viewpoint changes tiles or the map
+    # changes inside its window.
+    def __init__(self, grid, radius=FLOW_RADIUS, count=1):
+        self.grid,self.radius=grid,radius; n=2*radius+1; grid.watchers.append(self.invalidate)
+        self.origin=np.zeros((count,2),dtype=np.intp); self.stale=np.ones(count,dtype=bool)
+        self.dist=np.full((count,n,n),FLOW_UNREACHED,dtype=np.int16); self.step_x,self.step_y=np.zeros((count,n,n),dtype=np.int8),np.zeros((count,n,n),dtype=np.int8)
+
+    def _compute(self, tx, ty):
+        r=self.radius; n=2*r+1; d=np.arange(-r,r+1); k=len(tx)
+        walk=np.zeros((k,n+2,n+2),dtype=bool); walk[:,1:-1,1:-1]=self.grid.is_walkable(tx[:,None,None]+d,ty[:,None,None]+d[:,None]); walk[:,r+1,r+1]=True # Margin stays blocked
+        dist=np.full((k,n+2,n+2),FLOW_UNREACHED,dtype=np.int16); front=np.zeros_like(walk); front[:,r+1,r+1]=True; dist[front]=0; seen=front.copy(); step=0
+        while front.any():
+            step+=1; nb=np.zeros_like(front); nb[:,1:-1,1:-1]=front[:,:-2,1:-1]|front[:,2:,1:-1]|front[:,1:-1,:-2]|front[:,1:-1,2:]
+            front=nb&walk&~seen; seen|=front; dist[front]=step
+        cand=[]
+        for ox,oy in FLOW_STEPS:
+            nd=dist[:,1+oy:n+1+oy,1+ox:n+1+ox]
+            if ox and oy: nd=np.where(walk[:,1:-1,1+ox:n+1+ox]&walk[:,1+oy:n+1+oy,1:-1],nd,FLOW_UNREACHED)
+            cand.append(nd)
+        cand=np.stack(cand); best=cand.argmin(0); dist=dist[:,1:-1,1:-1]; closer=np.take_along_axis(cand,best[None],0)[0]<dist
+        steps=np.array(FLOW_STEPS,dtype=np.int8); return dist,np.where(closer,steps[best,0],0),np.where(closer,steps[best,1],0)
+
+    def update(self, tx, ty):
+        # Points each field at tile (tx[i], ty[i]); only rows that moved or were invalidated are rebuilt
+        origin=np.stack((np.atleast_1d(tx),np.atleast_1d(ty)),axis=1).astype(np.intp); rows=np.flatnonzero(self.stale|(origin!=self.origin).any(1))
+        if not len(rows): return
+        self.dist[rows],self.step_x[rows],self.step_y[rows]=self._compute(origin[rows,0],origin[rows,1]); self.origin[rows]=origin[rows]; self.stale[rows]=False
+
+    def steer(self, xs, ys, px, py, row=0):
+        # Where each mover at (xs, ys) should head: the centre of the next tile on its path, or straight for the viewpoint
+        # (px, py) once it shares its tile or when it has no path in the window; and its path length in steps (FLOW_UNREACHED
+        # without one). row picks the field (broadcast against xs for several).
+        r=self.radius; ix,iy=np.floor(xs).astype(np.intp),np.floor(ys).astype(np.intp); lx,ly=ix-self.origin[row,0]+r,iy-self.origin[row,1]+r
+        inside=(lx>=0)&(lx<=2*r)&(ly>=0)&(ly<=2*r); lx,ly=np.where(inside,lx,r),np.where(inside,ly,r)
+        sx,sy=self.step_x[row,ly,lx],self.step_y[row,ly,lx]; home=(sx==0)&(sy==0)
+        return np.where(home,px,ix+sx+0.5),np.where(home,py,iy+sy+0.5),np.where(inside,self.dist[row,ly,lx],FLOW_UNREACHED)
+
+    def invalidate(self, x, y):
+        # Map tile (x, y) changed: rebuild every field whose window holds it on its next update
+        self.stale|=(np.abs(self.origin[:,0]-x)<=self.radius)&(np.abs(self.origin[:,1]-y)<=self.radius)
+
+# --- Texture Store ---
+PALETTE_TRANSPARENT = 255 # Palette index of texels under half alpha; the other 255 entries come from median cut
+COLORMAP_LEVELS = 32 # Light levels in the colormap, from black (0) to full brightness
+
+def median_cut(colors, counts, n):
+    # Splits the box of colours with the largest count-weighted spread at the weighted median of its widest channel
+    # until there are n boxes. Returns each box's weighted mean colour and the box of every input colour.
+    def spread(b): return int(np.ptp(colors[b],axis=0).max())*int(counts[b].sum()) if len(b)>1 else -1
+    boxes=[np.arange(len(colors))]; prio=[spread(boxes[0])]
+    while len(boxes)<n and max(prio)>0:
+        k=int(np.argmax(prio)); b=boxes.pop(k); prio.pop(k); c=int(np.ptp(colors[b],axis=0).argmax()); b=b[np.argsort(colors[b,c],kind='stable')]
+        cum=np.cumsum(counts[b]); m=min(max(int(np.searchsorted(cum,cum[-1]/2))+1,1),len(b)-1)
+        for half in (b[:m],b[m:]): boxes.append(half); prio.append(spread(half))
+    which=np.empty(len(colors),dtype=np.intp)
+    for i,b in enumerate(boxes): which[b]=i
+    w=np.bincount(which,counts,len(boxes)); mean=np.stack([np.bincount(which,colors[:,c]*counts,len(boxes)) for c in range(3)],axis=1)/w[:,None]
+    return mean.round().astype(np.uint8),which
+
+class TextureStore:
+    # Wall and sprite textures packed into one contiguous RGBA buffer holding the whole mip chain.
+    # Each level is laid out (slot, x, y) so a vertical texture strip is one contiguous run.
+    def __init__(self, wall_textures, sprite_textures):
+        self.wall_lut=np.full(256,-1,dtype=np.intp); self.sprite_lut=np.full(256,-1,dtype=np.intp); base=[]
+        for lut,texs in ((self.wall_lut,wall_textures),(self.sprite_lut,sprite_textures)):
+            for k,t in sorted(texs.items()):
+                lut[k]=len(base); base.append(np.dstack((pygame.surfarray.array3d(t),pygame.surfarray.array_alpha(t))))
+        levels=[np.stack(base) if base else np.zeros((0,TEX_WIDTH,TEX_HEIGHT,4),dtype=np.uint8)]
+        while levels[-1].shape[1]>1: levels.append(self._downsample(levels[-1]))
+        self.mip_count=len(levels); self.level_offset=np.cumsum([0]+[l.shape[0]*l.shape[1]*l.shape[2] for l in levels])
+        self.texels=np.empty((self.level_offset[-1],4),dtype=np.uint8); self.levels=[]
+        for k,l in enumerate(levels):
+            self.texels[self.level_offset[k]:self.level_offset[k+1]]=l.reshape(-1,4); self.levels.append(self.texels[self.level_offset[k]:self.level_offset[k+1]].reshape(l.shape))
+
+    @staticmethod
+    def _downsample(level):
+        # 2x2 box filter weighted by alpha so transparent texels don't darken sprite edges
+        n,w,h,_=level.shape; a=level[...,3:].astype(np.float32); rgb=(level[...,:3]*a).reshape(n,w//2,2,h//2,2,3).sum((2,4))
+        a=a.reshape(n,w//2,2,h//2,2,1).sum((2,4)); rgb=rgb/np.maximum(a,1)
+        return np.concatenate((rgb,a/4),axis=3).round().astype(np.uint8)
+
+    def quantize(self, keep_rgba=False):
+        # Replaces the RGBA texels with palette indices for PalettedFrameBuffer (4x smaller), and adds the colormap: for
+        # each light level and palette index, the palette entry nearest that colour darkened, so shading is one lookup.
+        # keep_rgba keeps the RGBA texels too, for a store that also feeds a FrameBuffer.
+        opaque=self.texels[:,3]>=128; key=self.texels[opaque,:3].astype(np.uint32)@np.array([1<<16,1<<8,1],dtype=np.uint32)
+        key,inv,counts=np.unique(key,return_inverse=True,return_counts=True); colors=np.stack((key>>16,(key>>8)&255,key&255),axis=1).astype(np.int64)
+        pal,which=median_cut(colors,counts,PALETTE_TRANSPARENT)
+        self.indices=np.full(len(self.texels),PALETTE_TRANSPARENT,dtype=np.uint8); self.indices[opaque]=which[inv.reshape(-1)]
+        self.palette=np.zeros((256,3),dtype=np.uint8); self.palette[:len(pal)]=pal; self.palette[PALETTE_TRANSPARENT]=COLOR_TRANSPARENT
+        shc=(np.arange(COLORMAP_LEVELS)/(COLORMAP_LEVELS-1)*255).astype(np.int32); shaded=(self.palette.astype(np.int32)*shc[:,None,None]+255)>>8 # Same rounding as BLEND_MULT
+        self.colormap=np.stack([((lv[:,None,:]-pal.astype(np.int32))**2).sum(-1).argmin(1) for lv in shaded]).astype(np.uint8)
+        self.colormap[:,PALETTE_TRANSPARENT]=PALETTE_TRANSPARENT
+        if not keep_rgba: self.texels=self.levels=None
+
+    def mip_level(self, projected_h):
+        # Level whose texel height best matches the projected height, so narrow far columns read small mips
+        return np.clip(np.floor(np.log2(TEX_HEIGHT/np.maximum(projected_h,1))),0,self.mip_count-1).astype(np.intp)
+
+    def index(self, slots, tex_x, tex_y, level):
+        # Flat texel index for level-0 texel coordinates sampled from the given mip level
+        size=TEX_HEIGHT>>level; return self.level_offset[level]+(slots*size+(tex_x>>level))*size+(tex_y>>level)
+
+# --- Hitscan ---
+HITSCAN_RANGE = 20.0
+HITSCAN_RADIUS = 0.3
+
+def wall_reach(px, py, angles, max_dist=HITSCAN_RANGE, grid=None):
+    # Distance along each ray to the first wall a shot can't pass, capped at max_dist; px, py may be per-ray arrays
+    grid=MAP_GRID if grid is None else grid
+    rdx,rdy=np.cos(angles),np.sin(angles); gx,gy=px+GRID_PAD,py+GRID_PAD; mx,my,side,hit,_=_dda(gx,gy,rdx,rdy,grid.solid,int(2*max_dist)+2)
+    return np.minimum(np.where(hit,_hit_distance(gx,gy,rdx,rdy,mx,my,side),np.inf),max_dist)
+
+def hitscan(px, py, angles, xs, ys, max_dist=HITSCAN_RANGE, radius=HITSCAN_RADIUS, reach=None, valid=None, grid=None):
+    # Grid DDA finds each ray's first wall, then every target circle is intersected analytically.
+    # Targets are shared by all rays, or with per-ray origins px, py (R,) given per ray as xs, ys (R, S); valid masks targets out.
+    # Returns per ray the index of the nearest target hit (-1 for none) and the hit distance.
+    angles=np.atleast_1d(np.asarray(angles,dtype=float)); rdx,rdy=np.cos(angles),np.sin(angles)
+    if reach is None: reach=wall_reach(px,py,angles,max_dist,grid)
+    if not np.size(xs): return np.full(len(angles),-1),reach
+    ox,oy=np.asarray(xs)-np.asarray(px,dtype=float)[...,None],np.asarray(ys)-np.asarray(py,dtype=float)[...,None]
+    tc=rdx[:,None]*ox+rdy[:,None]*oy; half=np.sqrt(np.maximum(radius*radius-(ox*ox+oy*oy-tc*tc),0))
+    t=np.maximum(tc-half,0); t[(half==0)|(tc+half<0)|(t>=reach[:,None])|(False if valid is None else ~valid)]=np.inf
+    nearest=np.argmin(t,axis=1); dist=t[np.arange(len(angles)),nearest]
+    return np.where(np.isfinite(dist),nearest,-1),np.where(np.isfinite(dist),dist,reach)
+
 # --- Sprite Class ---
 class Sprite:
-    def __init__(self, x, y, texture_index, scale=1.0, static=True, health=30):
-        self.x, self.y=x,y; self.texture_index=texture_index; self.scale=scale; self.static=static
-        self.health,self.max_health=health,health; self.alive=True; self.dist_sq=0
-
-    def update(self, player_x, player_y, dt):
-        if not self.static and self.alive:
-            dx,dy=player_x-self.x,player_y-self.y; dist=math.hypot(dx,dy)
-            if 1.5<dist<8.0 and dist>1e-6:
-                 speed=0.02*(1+random.uniform(-0.2,0.2))
-                 nx,ny=self.x+(dx/dist)*speed,self.y+(dy/dist)*speed; mx,my=int(nx),int(ny)
-                 if 0<=mx<MAP_WIDTH and 0<=my<MAP_HEIGHT and MAP_GRID[my][mx]==T_EMPTY: self.x,self.y=nx,ny
+    # View of one entry in a SpriteWorld; reads and writes go straight to the world's arrays
+    __slots__=('world','i')
+    def __init__(self, world, i): self.world,self.i=world,i
+    x=property(lambda s:float(s.world.x[s.i]),lambda s,v:s.world.move(s.i,v,s.world.y[s.i]))
+    y=property(lambda s:float(s.world.y[s.i]),lambda s,v:s.world.move(s.i,s.world.x[s.i],v))
+    texture_index=property(lambda s:int(s.world.texture_index[s.i]),lambda s,v:s.world.texture_index.__setitem__(s.i,v))
+    scale=property(lambda s:float(s.world.scale[s.i]),lambda s,v:s.world.scale.__setitem__(s.i,v))
+    static=property(lambda s:bool(s.world.static[s.i]),lambda s,v:s.world.static.__setitem__(s.i,v))
+    health=property(lambda s:int(s.world.health[s.i]),lambda s,v:s.world.health.__setitem__(s.i,v))
+    max_health=property(lambda s:int(s.world.max_health[s.i]))
+    alive=property(lambda s:bool(s.world.alive[s.i]),lambda s,v:s.world.alive.__setitem__(s.i,v))
 
     def take_damage(self, amount, sounds_dict):
         if not self.alive: return False
@@ -295,24 +878,482 @@ class Sprite:
         if self.health<=0: self.alive,self.health=False,0; print("Sprite died!"); sounds_dict.get('enemy_death',DummySound()).play(); return True
         else: sounds_dict.get('enemy_pain',DummySound()).play(); return False
 
+SPRITE_SPEED = 0.6 # Units per second
+
+class SpriteWorld:
+    # All sprites as parallel NumPy arrays, plus a per-tile bucket index (tile -> set of sprite indices)
+    # kept current as sprites move, so contact and hitscan queries only look at nearby sprites.
+    FIELDS=(('x',float),('y',float),('texture_index',np.int16),('scale',float),('static',bool),('health',np.int32),('max_health',np.int32),('alive',bool),('cell',np.intp),
+            ('prev_x',float),('prev_y',float))
+
+    def __init__(self, capacity=16):
+        self.count,self.map_width,self.buckets=0,1,{}
+        for name,dt in self.FIELDS: setattr(self,name,np.zeros(capacity,dtype=dt))
+
+    def __len__(self): return self.count
+    def __getitem__(self, i): return Sprite(self,i)
+    def __iter__(self): return (Sprite(self,i) for i in range(self.count))
+
+    def clear(self, map_width):
+        self.count,self.map_width=0,map_width; self.buckets.clear()
+
+    def _reserve(self, n):
+        while self.count+n>len(self.x):
+            for name,_ in self.FIELDS: a=getattr(self,name); setattr(self,name,np.concatenate((a,np.zeros_like(a))))
+
+    def add(self, x, y, texture_index, scale=1.0, static=True, health=30):
+        self._reserve(1); i=self.count; self.count+=1
+        self.x[i],self.y[i],self.texture_index[i],self.scale[i],self.static[i]=x,y,texture_index,scale,static; self.prev_x[i],self.prev_y[i]=x,y
+        self.health[i]=self.max_health[i]=health; self.alive[i]=True
+        self.cell[i]=self._cells(np.array([x]),np.array([y]))[0]; self.buckets.setdefault(self.cell[i],set()).add(i)
+        return Sprite(self,i)
+
+    def extend(self, table):
+        # Adds every row of a LEVEL_SPRITE table at once
+        n=len(table); self._reserve(n); i=slice(self.count,self.count+n); idx=range(self.count,self.count+n); self.count+=n
+        for name in ('x','y','texture_index','scale','static'): getattr(self,name)[i]=table[name]
+        self.prev_x[i],self.prev_y[i]=table['x'],table['y']; self.health[i]=self.max_health[i]=table['health']; self.alive[i]=True
+        self.cell[i]=self._cells(table['x'],table['y'])
+        for k,c in zip(idx,self.cell[i].tolist()): self.buckets.setdefault(c,set()).add(k)
+
+    def _cells(self, xs, ys): return np.floor(ys).astype(np.intp)*self.map_width+np.floor(xs).astype(np.intp)
+
+    def move(self, i, x, y): self.x[i],self.y[i]=x,y; self._rebucket(np.array([i]))
+
+    def _rebucket(self, idx):
+        new=self._cells(self.x[idx],self.y[idx]); changed=new!=self.cell[idx]
+        for i,c in zip(idx[changed].tolist(),new[changed].tolist()):
+            self.buckets[self.cell[i]].discard(i); self.buckets.setdefault(c,set()).add(i); self.cell[i]=c
+
+    def in_cells(self, cells):
+        out=[]; [out.extend(self.buckets.get(c,())) for c in np.unique(cells).tolist()]
+        return np.sort(np.array(out,dtype=np.intp))
+
+    def near(self, x, y, radius):
+        # Candidates from the tiles overlapped by the query circle's bounding box
+        xs,ys=np.arange(math.floor(x-radius),math.floor(x+radius)+1),np.arange(math.floor(y-radius),math.floor(y+radius)+1)
+        return self.in_cells((ys[:,None]*self.map_width+xs[None,:]).ravel())
+
+    def snapshot(self):
+        # Remembers positions at the start of a tick for render interpolation
+        n=self.count; self.prev_x[:n]=self.x[:n]; self.prev_y[:n]=self.y[:n]
+
+    def interpolated(self, idx, alpha):
+        return self.prev_x[idx]+(self.x[idx]-self.prev_x[idx])*alpha,self.prev_y[idx]+(self.y[idx]-self.prev_y[idx])*alpha
+
+    def update(self, player_x, player_y, dt, pvs=None, flow=None):
+        # Moves live enemies toward the player. With a FlowField those with a path follow it around walls and the rest head
+        # straight for the player; without one all head straight for the player. With a VisibilitySets only those in tiles
+        # visible from the player's tile move, plus, with a FlowField, those at most FLOW_WAKE_STEPS along a path from them.
+        n=self.count; x,y=self.x[:n],self.y[:n]; dist=np.hypot(player_x-x,player_y-y)
+        idx=np.flatnonzero(self.alive[:n]&~self.static[:n]&(dist>1.5)&(dist<8.0)); gx,gy=player_x,player_y
+        if flow is not None: flow.update(math.floor(player_x),math.floor(player_y)); gx,gy,steps=flow.steer(x[idx],y[idx],player_x,player_y)
+        if pvs is not None:
+            awake=pvs.visible(player_x,player_y,x[idx],y[idx])
+            if flow is not None: awake|=steps<=FLOW_WAKE_STEPS; gx,gy=gx[awake],gy[awake]
+            idx=idx[awake]
+        if not len(idx): return
+        dx,dy=gx-x[idx],gy-y[idx]; d=np.hypot(dx,dy)
+        speed=SPRITE_SPEED*dt*(1+np.random.uniform(-0.2,0.2,len(idx))); nx,ny=x[idx]+dx/d*speed,y[idx]+dy/d*speed
+        ok=MAP_GRID.is_walkable(nx,ny)
+        idx=idx[ok]; self.x[idx],self.y[idx]=nx[ok],ny[ok]; self._rebucket(idx)
+
+    def contacts(self, x, y, radius_sq):
+        # Live sprites whose centres are within sqrt(radius_sq) of (x, y)
+        idx=self.near(x,y,math.sqrt(radius_sq)); idx=idx[self.alive[idx]]
+        return idx[(self.x[idx]-x)**2+(self.y[idx]-y)**2<radius_sq]
+
+    def drawable(self, pvs=None, px=0.0, py=0.0):
+        # Live sprites and corpses; with a VisibilitySets only those in tiles visible from (px, py)
+        n=self.count; idx=np.flatnonzero(self.alive[:n]|(self.texture_index[:n]==99))
+        return idx if pvs is None else idx[pvs.visible(px,py,self.x[idx],self.y[idx])]
+
+    def hitscan(self, px, py, angles, max_dist=HITSCAN_RANGE, radius=HITSCAN_RADIUS):
+        # Only live, non-static sprites bucketed in the tiles along each ray (dilated by one tile for the radius) are tested
+        angles=np.atleast_1d(np.asarray(angles,dtype=float)); reach=wall_reach(px,py,angles,max_dist)
+        t=np.arange(0,reach.max()+0.5,0.5); sx,sy=px+np.cos(angles)[:,None]*np.minimum(t,reach[:,None]),py+np.sin(angles)[:,None]*np.minimum(t,reach[:,None])
+        near=np.array([-1,0,1]); cells=(np.floor(sy).astype(np.intp).ravel()[:,None,None]+near[:,None])*self.map_width+(np.floor(sx).astype(np.intp).ravel()[:,None,None]+near[None,:])
+        idx=self.in_cells(cells.ravel()); idx=idx[self.alive[idx]&~self.static[idx]]
+        hit,dist=hitscan(px,py,angles,self.x[idx],self.y[idx],max_dist,radius,reach)
+        return np.where(hit>=0,idx[np.maximum(hit,0)] if len(idx) else -1,-1),dist
+
+sprites = SpriteWorld()
+
+# --- Framebuffer ---
+SPRITE_SHADE_LEVELS = 32 # Shade quantization for cached sprite images
+SPRITE_CACHE_SIZE = 128
+RENDER_BANDS = 1 # Vertical column bands rendered in parallel threads; 1 renders on the calling thread
+RENDER_SCALE = None # Fixed internal resolution as a fraction of the window; None lets ResolutionController choose
+PALETTED = False # Render through the 256-colour palette and colormap (PalettedFrameBuffer)
+
+class FrameBuffer:
+    # Whole frame as one (x, y, rgb) array, written with gathered texel rows and blitted once per frame.
+    # With bands > 1 the screen is split into vertical column bands, each raycast, textured and composited
+    # on its own thread; NumPy releases the GIL for the heavy array work and bands never share a column.
+    def __init__(self, width, height, store=None, bands=1):
+        self.width,self.height=width,height; self.pixels=np.zeros((width,height,3),dtype=np.uint8)
+        self.depth=np.full(width,float('inf'),dtype=float); self.rows=np.arange(height); self.store=store; self.sprite_cache={}; self.staging=None; self.backdrop=None
+        self.wall_key=self.wall_fan=self.wall_layer=None # Coherence cache: pose of the last wall pass, its rays and its output
+        self.flats=self._flat_tables() if store is not None and store.wall_lut[FLOOR_TEXTURE]>=0 and store.wall_lut[CEILING_TEXTURE]>=0 else None
+        self.bands=max(1,min(bands,width)); edges=np.linspace(0,width,self.bands+1).astype(int); self.band_ranges=list(zip(edges[:-1].tolist(),edges[1:].tolist()))
+        self.pool=concurrent.futures.ThreadPoolExecutor(self.bands,thread_name_prefix='render') if self.bands>1 else None
+
+    def _flat_tables(self):
+        # Per floor row below the horizon: camera distance H/(2y-H), texel size and offset of the floor texture at that row's
+        # mip level, offset from there to the ceiling texture, and shade. Ceiling rows mirror floor rows, so they share every table.
+        H=self.height; st=self.store; rows=np.arange(H//2+1,H); dist=H/(2*rows-H); level=st.mip_level(2*rows-H); size=TEX_HEIGHT>>level
+        fs,cs=st.wall_lut[FLOOR_TEXTURE],st.wall_lut[CEILING_TEXTURE]; shade=(np.clip(1.0/(1+dist*0.1),0.2,1.0)*255).astype(np.uint32)
+        return rows,dist.astype(np.float32),size.astype(np.float32),(size-1).astype(np.int32),size.astype(np.int32),(st.level_offset[level]+fs*size*size).astype(np.int32),(int(cs-fs)*size*size).astype(np.int32),shade
+
+    def close(self):
+        if self.pool: self.pool.shutdown()
+
+    def _each_band(self, fn):
+        # Results of fn per band, in screen order
+        if self.pool is None: return [fn(0,self.width)]
+        return list(self.pool.map(lambda r:fn(*r),self.band_ranges)) # list() re-raises worker exceptions
+
+    def render_walls(self, px, py, angle, ceiling, floor):
+        # An unchanged pose and map restores the last wall layer outright; an unchanged position reuses its rays (cast_walls' fan)
+        spot=(MAP_GRID,MAP_GRID.version,px,py); key=(spot,angle,ceiling,floor)
+        if self.wall_key==key: np.copyto(self.pixels,self.wall_layer); self.depth[:]=self.wall_depth; return
+        fan=self.wall_fan if self.wall_key is not None and self.wall_key[0]==spot else None
+        def band(x0, x1):
+            if self.flats: self.draw_flats(px,py,angle,ceiling,floor,x0,x1)
+            else: self.clear(ceiling,floor,x0,x1)
+            *cols,rays=cast_walls(px,py,angle,self.depth[x0:x1],self.width,self.height,x0,fan); self.draw_walls(*cols,x0=x0); return rays
+        rays=self._each_band(band); self.wall_fan=tuple(np.concatenate(a) for a in zip(*rays)); self.wall_key=key
+        if self.wall_layer is None: self.wall_layer=np.empty_like(self.pixels)
+        np.copyto(self.wall_layer,self.pixels); self.wall_depth=self.depth.copy()
+
+    def render_sprites(self, px, py, angle, xs, ys, tex_ids, scales):
+        self._each_band(lambda x0,x1:self.draw_sprites(px,py,angle,xs,ys,tex_ids,scales,x0,x1))
+
+    def clear(self, ceiling, floor, x0=0, x1=None):
+        # Copies a cached ceiling/floor backdrop, much cheaper than broadcasting two colours over the frame
+        if self.backdrop is None or self.backdrop[0]!=(ceiling,floor):
+            img=np.empty_like(self.pixels); img[:,:self.height//2]=self.color(ceiling); img[:,self.height//2:]=self.color(floor); self.backdrop=((ceiling,floor),img)
+        self.pixels[x0:x1]=self.backdrop[1][x0:x1]; self.depth[x0:x1]=float('inf')
+
+    def draw_flats(self, px, py, angle, ceiling, floor, x0=0, x1=None):
+        # Textured floor and ceiling for columns [x0, x1): each pixel below the horizon is the world point at its row's
+        # distance along its column's ray, computed for the whole half-screen in one broadcast
+        rows,dist,fsize,mask,size,base,delta,_=self.flats; H=self.height; x1=self.width if x1 is None else x1
+        if not len(rows): self.clear(ceiling,floor,x0,x1); return
+        self.pixels[x0:x1,H-rows[0]:H//2]=self.color(ceiling); self.pixels[x0:x1,H//2:rows[0]]=self.color(floor); self.depth[x0:x1]=float('inf') # Horizon rows
+        dirX,dirY=math.cos(angle),math.sin(angle); planeX,planeY=math.sin(angle)*0.66,-math.cos(angle)*0.66
+        cam=(2*np.arange(x0,x1)/self.width-1).astype(np.float32)
+        tx=((px+dist*(dirX+planeX*cam)[:,None])*fsize).astype(np.int32)&mask; ty=((py+dist*(dirY+planeY*cam)[:,None])*fsize).astype(np.int32)&mask
+        idx=base+tx*size+ty
+        for off,ys in ((0,slice(rows[0],H)),(delta,slice(H-1-rows[0],None,-1))): self._put_flat(self.pixels[x0:x1,ys],idx+off)
+
+    def _put_flat(self, out, idx):
+        # One 4-byte gather per pixel, shaded on the packed texel: red/blue and green each fit one multiply without carries
+        shc=self.flats[7]; v=self.store.texels.view(np.uint32).ravel()[idx]; v=(((v&0x00FF00FF)*shc+0x00FF00FF)>>8&0x00FF00FF)|(((v&0x0000FF00)*shc+0x0000FF00)>>8&0x0000FF00)
+        rgb=v.view(np.uint8).reshape(v.shape+(4,))
+        for c in range(3): out[...,c]=rgb[...,c] # Per channel: copying a 4-byte stride into a 3-byte one as a whole is far slower
+
+    def draw_walls(self, tiles, tex_x, line_h, shade, x0=0):
+        H=self.height; st=self.store; slots=st.wall_lut[np.clip(tiles,0,255)]; top,bot=H//2+(-line_h//2),H//2+line_h//2
+        cols=(line_h>0)&(slots>=0); ds,de=np.maximum(0,top),np.minimum(H,bot)
+        xi,yi=np.nonzero(cols[:,None]&(self.rows>=ds[:,None])&(self.rows<de[:,None]))
+        ty=np.minimum(((yi-top[xi])*TEX_HEIGHT)//(bot-top)[xi],TEX_HEIGHT-1)
+        self._put_walls(x0+xi,yi,st.index(slots[xi],tex_x[xi],ty,st.mip_level(line_h)[xi]),shade,xi)
+
+    def _put_walls(self, xs, ys, idx, shade, col):
+        # Texels idx at pixels (xs, ys), darkened by their column's shade
+        shc=(shade*255).astype(np.uint16); self.pixels[xs,ys]=(self.store.texels[idx,:3]*shc[col,None]+255)>>8 # Same rounding as BLEND_MULT
+
+    def draw_sprites(self, px, py, angle, xs, ys, tex_ids, scales, x0=0, x1=None):
+        # Projects every sprite in one vectorized step, then composites each visible one far-to-near into columns [x0, x1)
+        if not len(xs): return
+        x1=self.width if x1 is None else x1
+        W,H=self.width,self.height; dirX,dirY=math.cos(angle),math.sin(angle); planeX,planeY=math.sin(angle)*0.66,-math.cos(angle)*0.66
+        sxr,syr=xs-px,ys-py; inv_det=1.0/(planeX*dirY-dirX*planeY); tx=inv_det*(dirY*sxr-dirX*syr); ty=inv_det*(-planeY*sxr+planeX*syr)
+        vis=ty>0.1; ty_s=np.where(vis,ty,1.0)
+        ssx=((W/2)*(1+tx/ty_s)).astype(np.intp); size=np.abs(((H/ty_s)*scales).astype(np.intp)); vis&=(size>0)&(ssx-size//2<x1)&(ssx+size//2>x0)
+        shade=np.clip(1.0/(1+ty_s*0.15),0.3,1.0)
+        for i in np.flatnonzero(vis)[np.argsort(-(sxr*sxr+syr*syr)[vis],kind='stable')]:
+            self.draw_sprite(int(tex_ids[i]),int(ssx[i]),int(size[i]),ty[i],shade[i],x0,x1)
+
+    def draw_sprite(self, texture_index, ssx, size, ty, shade, band_x0=0, band_x1=None):
+        st=self.store; slot=st.sprite_lut[texture_index] if 0<=texture_index<256 else -1
+        if slot<0: return
+        H=self.height; step=max(1,size>>5); size=size//step*step; shade=round(shade*SPRITE_SHADE_LEVELS)
+        dsx,dsy=ssx-size//2,H//2-size//2; x0,x1,y0,y1=max(band_x0,dsx),min(self.width if band_x1 is None else band_x1,ssx+size//2),max(0,dsy),min(H,H//2+size//2)
+        if x0>=x1 or y0>=y1: return
+        if size<=H: # Whole sprite scaled and shaded once, reused while its quantized size and shade stay the same
+            key=(slot,size,shade); img=self.sprite_cache.get(key)
+            if img is None:
+                if len(self.sprite_cache)>=SPRITE_CACHE_SIZE: self.sprite_cache.clear()
+                img=self.sprite_cache[key]=self._scale_sprite(slot,size,shade,0,2*(size//2),0,2*(size//2))
+            rgb,opaque=img[0][x0-dsx:x1-dsx,y0-dsy:y1-dsy],img[1][x0-dsx:x1-dsx,y0-dsy:y1-dsy]
+        else: rgb,opaque=self._scale_sprite(slot,size,shade,x0-dsx,x1-dsx,y0-dsy,y1-dsy) # Close-up: only the on-screen window
+        mask=opaque&(ty<self.depth[x0:x1])[:,None]
+        np.copyto(self.pixels[x0:x1,y0:y1],rgb,where=mask if rgb.ndim==2 else mask[...,None])
+
+    def _scale_sprite(self, slot, size, shade, u0, u1, v0, v1):
+        st=self.store; span=2*(size//2); u,v=np.arange(u0,u1),np.arange(v0,v1)
+        tx,ty=np.minimum((u*TEX_WIDTH)//span,TEX_WIDTH-1),np.minimum((v*TEX_HEIGHT)//span,TEX_HEIGHT-1)
+        return self._shade_sprite(st.index(slot,tx[:,None],ty[None,:],int(st.mip_level(size))),shade)
+
+    def _shade_sprite(self, idx, shade):
+        # Texels idx darkened by shade (in SPRITE_SHADE_LEVELS steps), and which of them are opaque
+        texel=self.store.texels[idx]; shc=int(shade*255/SPRITE_SHADE_LEVELS)
+        return ((texel[...,:3].astype(np.uint16)*shc+255)>>8).astype(np.uint8),texel[...,3]>=128
+
+    def color(self, rgb): return rgb # Pixel value for an RGB colour
+
+    def present(self, surface):
+        # Blits straight into a surface of the same size, otherwise through a staging surface upscaled once
+        if surface.get_size()==(self.width,self.height): pygame.surfarray.blit_array(surface,self.pixels); return
+        if self.staging is None: self.staging=pygame.Surface((self.width,self.height),0,surface)
+        pygame.surfarray.blit_array(self.staging,self.pixels); pygame.transform.scale(self.staging,surface.get_size(),surface)
+
+class PalettedFrameBuffer(FrameBuffer):
+    # FrameBuffer over a quantized TextureStore: pixels are (x, y) palette indices, texels are gathered as indices and
+    # shaded through the store's colormap, and SDL expands the finished frame through an 8-bit surface holding the palette.
+    def __init__(self, width, height, store, bands=1):
+        super().__init__(width,height,store,bands); self.pixels=np.zeros((width,height),dtype=np.uint8); self.indexed=None; self.colors={}
+        if self.flats: self.flat_light=self._light(self.flats[7]/255.0)
+
+    @staticmethod
+    def _light(shade): return np.rint(np.asarray(shade)*(COLORMAP_LEVELS-1)).astype(np.intp)
+
+    def color(self, rgb):
+        if rgb not in self.colors: pal=self.store.palette[:PALETTE_TRANSPARENT].astype(np.int32); self.colors[rgb]=np.uint8(((pal-rgb)**2).sum(1).argmin())
+        return self.colors[rgb]
+
+    def _put_flat(self, out, idx): out[...]=self.store.colormap[self.flat_light,self.store.indices[idx]]
+
+    def _put_walls(self, xs, ys, idx, shade, col): self.pixels[xs,ys]=self.store.colormap[self._light(shade)[col],self.store.indices[idx]]
+
+    def _shade_sprite(self, idx, shade):
+        idx=self.store.indices[idx]; return self.store.colormap[self._light(shade/SPRITE_SHADE_LEVELS),idx],idx!=PALETTE_TRANSPARENT
+
+    def present(self, surface):
+        if self.indexed is None: self.indexed=pygame.Surface((self.width,self.height),0,8); self.indexed.set_palette([tuple(c) for c in self.store.palette.tolist()])
+        pygame.surfarray.blit_array(self.indexed,self.pixels)
+        if surface.get_size()==(self.width,self.height): surface.blit(self.indexed,(0,0)); return
+        if self.staging is None: self.staging=pygame.Surface((self.width,self.height),0,surface)
+        self.staging.blit(self.indexed,(0,0)); pygame.transform.scale(self.staging,surface.get_size(),surface)
+
+# --- Profiler ---
+PROFILE_STAGES = ('events', 'hitscan', 'update', 'walls', 'sprites', 'present', 'hud', 'flip')
+PROFILE_COLORS = [(120,120,120), (255,140,0), (0,200,0), (70,110,255), (220,60,220), (255,90,90), (240,240,0), (0,220,220)]
+PROFILE_FRAMES = 240 # Ring buffer length
+PROFILE_GRAPH_H = 100
+PROFILE_GRAPH_MS = 2000.0/FPS # Graph height corresponds to two frame budgets
+
+class FrameProfiler:
+    # Per-stage frame timings from perf_counter_ns kept in a fixed-size ring buffer.
+    # Every method returns straight away while disabled, so instrumentation can stay in the main loop.
+    def __init__(self, stages=PROFILE_STAGES, capacity=PROFILE_FRAMES):
+        self.stages=stages; self.slot={s:i for i,s in enumerate(stages)}; self.buf=np.zeros((capacity,len(stages)),dtype=np.int64)
+        self.head,self.filled,self.enabled,self.requested,self._t,self._row=0,0,False,False,0,None; self._legend=None
+
+    def toggle(self): self.requested=not self.requested # Takes effect at the next frame boundary
+
+    def begin_frame(self):
+        self.enabled=self.requested
+        if not self.enabled: return
+        self._row=self.buf[self.head]; self._row.fill(0); self._t=time.perf_counter_ns()
+
+    def mark(self, stage):
+        # Charges the time since the previous mark to stage
+        if not self.enabled: return
+        t=time.perf_counter_ns(); self._row[self.slot[stage]]+=t-self._t; self._t=t
+
+    def end_frame(self):
+        if not self.enabled: return
+        self.head=(self.head+1)%len(self.buf); self.filled=min(self.filled+1,len(self.buf))
+
+    def frames(self):
+        # Recorded rows, oldest first
+        return np.roll(self.buf,-self.head,axis=0)[len(self.buf)-self.filled:]
+
+    def draw_overlay(self, screen, font):
+        # Stacked per-stage bar per frame, newest on the right, with a line at the frame budget
+        if not self.enabled: return
+        n,H=len(self.buf),PROFILE_GRAPH_H; px=np.zeros((n,len(self.stages)))
+        if self.filled: px[n-self.filled:]=np.cumsum(self.frames()/1e6,axis=1)*H/PROFILE_GRAPH_MS
+        layer=(np.arange(H)[None,:,None]>=px[:,None,:]).sum(axis=2) # Stage under each pixel, len(stages) for empty
+        img=np.array(PROFILE_COLORS+[(20,20,20)],dtype=np.uint8)[layer[:,::-1]]; img[:,H-1-int(H*1000/FPS/PROFILE_GRAPH_MS)]=COLOR_WHITE
+        graph=pygame.surfarray.make_surface(img); graph.set_alpha(200); x0,y0=10,screen.get_height()-H-60; screen.blit(graph,(x0,y0))
+        if font:
+            if self._legend is None:
+                labels=[font.render(s,1,c) for s,c in zip(self.stages,PROFILE_COLORS)]; self._legend=pygame.Surface((sum(l.get_width()+8 for l in labels),font.get_linesize()),pygame.SRCALPHA); lx=0
+                for l in labels: self._legend.blit(l,(lx,0)); lx+=l.get_width()+8
+            screen.blit(self._legend,(x0,y0-font.get_linesize()))
+
+    def dump_csv(self, path):
+        rows=self.frames()
+        with open(path,'w') as f:
+            f.write("frame,"+",".join(f"{s}_ns" for s in self.stages)+",total_ns\n")
+            for i,r in enumerate(rows): f.write(f"{i},"+",".join(str(v) for v in r)+f",{r.sum()}\n")
+        print(f"Profile: {len(rows)} frames written to {path}"); return path
+
+# --- Layers ---
+MINIMAP_CELL = 8 # Pixels per tile on the debug map
+CROSSHAIR_SIZE = 8
+
+class LayerCache:
+    # Overlay surfaces that only change with their key (level, map version, window, fonts...), built on first use
+    # and whenever the key changes, so static parts of the screen aren't redrawn every frame.
+    def __init__(self): self.layers={}
+
+    def get(self, name, key, build):
+        entry=self.layers.get(name)
+        if entry is None or entry[0]!=key: entry=self.layers[name]=(key,build())
+        return entry[1]
+
+def build_minimap_layer(tiles, cell=MINIMAP_CELL):
+    # Translucent backing plus one square per textured tile of an unpadded tile window, with a 5 px border
+    h,w=tiles.shape; surf=pygame.Surface((w*cell+10,h*cell+10),pygame.SRCALPHA); surf.fill((20,20,20,180))
+    colors={k:((0,255,255) if k==T_EXIT else t.get_at((0,0))) for k,t in textures.items()}
+    for y,row in enumerate(tiles.tolist()):
+        for x,tile in enumerate(row):
+            if tile in colors: surf.fill(colors[tile],(5+x*cell,5+y*cell,cell-1,cell-1))
+    return surf
+
+def build_crosshair_layer(size=CROSSHAIR_SIZE):
+    surf=pygame.Surface((2*size+1,2*size+1),pygame.SRCALPHA)
+    pygame.draw.line(surf,COLOR_WHITE,(0,size),(2*size,size),1); pygame.draw.line(surf,COLOR_WHITE,(size,0),(size,2*size),1)
+    return surf
+
+def build_game_over_layer(font, size=(SCREEN_WIDTH, SCREEN_HEIGHT)):
+    surf=pygame.Surface(size); surf.fill(COLOR_BLACK); w,h=size
+    if font:
+        msg=font.render("GAME OVER",1,COLOR_RED); surf.blit(msg,msg.get_rect(center=(w//2,h//2-40)))
+        ex=font.render("Press ESC to Exit",1,COLOR_WHITE); surf.blit(ex,ex.get_rect(center=(w//2,h//2+40)))
+    return surf
+
+def build_generator_layer(size=(SCREEN_WIDTH, SCREEN_HEIGHT)):
+    # Win screen backdrop: the newest generated textures tiled from the top left
+    surf=pygame.Surface(size); surf.fill(COLOR_BLACK); ti=0
+    for y in range(generator_grid_size):
+        for x in range(generator_grid_size):
+            if ti<len(generator_textures): surf.blit(generator_textures[len(generator_textures)-1-ti],(x*generator_tex_size,y*generator_tex_size))
+            ti+=1
+    return surf
+
+layers = LayerCache()
+
+# --- Dynamic Resolution ---
+DYNRES_TARGET_MS = 1000.0/FPS # p95 frame work time to stay under
+DYNRES_INTERVAL = 1.0 # Seconds between adjustments
+DYNRES_MIN_SCALE = 0.35
+DYNRES_STEP = 0.05 # Scales are quantized to this so small jitter does not rebuild the framebuffer
+DYNRES_HEADROOM = 0.75 # Only scale back up when p95 is this far under the target
+
+class ResolutionController:
+    # Picks the internal render scale (fraction of the window size on each axis) from the frame times of the last interval.
+    # Over target it drops straight to the scale that should fit, since cost follows the pixel count (scale squared);
+    # with headroom to spare it climbs back one step at a time.
+    def __init__(self, target_ms=DYNRES_TARGET_MS, interval=DYNRES_INTERVAL, min_scale=DYNRES_MIN_SCALE, scale=1.0):
+        self.target_ms,self.interval,self.min_scale,self.scale=target_ms,interval,min_scale,scale
+        self.samples=[]; self.window_start=None; self.last_p95=0.0
+
+    def record(self, frame_ms): self.samples.append(frame_ms)
+
+    def update(self, now):
+        # Returns the new scale when it changes, otherwise None
+        if self.window_start is None: self.window_start=now
+        if now-self.window_start<self.interval or not self.samples: return None
+        p95=self.last_p95=float(np.percentile(self.samples,95)); self.samples.clear(); self.window_start=now; scale=self.scale
+        if p95>self.target_ms: scale=math.floor(scale*math.sqrt(self.target_ms/p95)/DYNRES_STEP)*DYNRES_STEP
+        elif p95<self.target_ms*DYNRES_HEADROOM: scale+=DYNRES_STEP
+        scale=round(min(1.0,max(self.min_scale,scale)),2)
+        if scale==self.scale: return None
+        self.scale=scale; return scale
+
+def render_size(scale, width=SCREEN_WIDTH, height=SCREEN_HEIGHT): return max(1,round(width*scale)),max(1,round(height*scale))
+
 # --- Game Functions ---
+def level_data(level_index):
+    # LEVELS entries are level dicts or paths to binary level files
+    ld=LEVELS[level_index]; return read_level_file(ld) if isinstance(ld,str) else ld
+
 def load_level(level_index):
-    global MAP_GRID,MAP_WIDTH,MAP_HEIGHT,player_x,player_y,player_angle,sprites
+    global MAP_GRID,PVS,FLOW,LEVEL_START,LEVEL_MUSIC,MAP_WIDTH,MAP_HEIGHT,player_x,player_y,player_angle,sprites
     if 0<=level_index<MAX_LEVELS:
-        ld=LEVELS[level_index]; MAP_GRID=[r[:] for r in ld["map"]]; MAP_WIDTH,MAP_HEIGHT=len(MAP_GRID[0]),len(MAP_GRID)
-        player_x,player_y=ld["player_start"]; player_angle=ld["player_angle"]
-        sprites.clear(); [sprites.append(Sprite(*sd)) for sd in ld["sprites"]]
+        try: ld=level_data(level_index)
+        except (OSError,ValueError) as e: print(f"Error: Can't load level {level_index}: {e}"); return False
+        MAP_GRID=ld["map"] if isinstance(ld["map"],LevelGrid) else LevelGrid(ld["map"]); MAP_WIDTH,MAP_HEIGHT=MAP_GRID.width,MAP_GRID.height
+        if PVS is not None: PVS.close()
+        PVS=VisibilitySets(MAP_GRID); FLOW=FlowField(MAP_GRID)
+        player_x,player_y=ld["player_start"]; player_angle=ld["player_angle"]; LEVEL_START=(player_x,player_y,player_angle); LEVEL_MUSIC=ld["music"]
+        sprites.clear(MAP_WIDTH); sprites.extend(sprite_table(ld["sprites"]))
         print(f"Loaded Level {level_index}"); return True
     else: print(f"Error: Invalid level index {level_index}"); return False
 
 def play_level_music(level_index, sounds_dict):
-    global music_channel; print(f"Placeholder: Music '{LEVELS[level_index]['music']}'")
+    # Streams the loaded level's music on mixer channel 0, reserved so sound effects never take it
+    global music_channel
     if music_channel: music_channel.stop()
-    # mt=sounds_dict.get(LEVELS[level_index]['music']); if mt: music_channel=pygame.mixer.find_channel(True); if music_channel: music_channel.play(mt, loops=-1)
+    if not pygame.mixer.get_init(): music_channel=DummySound(); return music_channel
+    key=LEVEL_MUSIC; print(f"Music: '{key}'"); pygame.mixer.set_reserved(1)
+    music_channel=MusicStreamer(pygame.mixer.Channel(0),music_track(key),level_index); return music_channel
+
+def asset_key(kind, params):
+    # Hash of everything that determines an asset's content; also seeds its generator
+    return hashlib.sha1(repr((ASSET_VERSION,kind,params,TEX_WIDTH,TEX_HEIGHT,SAMPLE_RATE,AUDIO_CHANNELS)).encode()).hexdigest()
+
+def build_asset(kind, params, key):
+    # Runs in asset worker processes: generates one asset from its parameters and returns its pixels or samples
+    seed=int(key[:8],16)
+    if kind=='sound': return synth_wave(rng=np.random.default_rng(seed),**params)
+    if kind=='texture': return pygame.surfarray.array3d(generate_texture((TEX_WIDTH,TEX_HEIGHT),*params,rng=random.Random(seed)))
+    tex=generate_alpha_texture((TEX_WIDTH,TEX_HEIGHT),*params,rng=random.Random(seed))
+    return np.dstack((pygame.surfarray.array3d(tex),pygame.surfarray.array_alpha(tex)))
+
+def load_asset_arrays(jobs, cache_dir=ASSET_CACHE_DIR):
+    # Maps cached .npy blobs for every (kind, name, params) job; misses are generated in a process pool and written back
+    arrays,misses={},[]
+    for kind,name,params in jobs:
+        key=asset_key(kind,params); path=os.path.join(cache_dir,f"{kind}_{key}.npy")
+        try: arrays[(kind,name)]=np.load(path,mmap_mode='r')
+        except (OSError,ValueError): misses.append((kind,name,params,key,path))
+    if not misses: return arrays
+    print(f"Asset cache: generating {len(misses)} of {len(jobs)} assets")
+    results=None
+    if len(misses)>=ASSET_POOL_MIN_JOBS:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(min(len(misses),os.cpu_count() or 1),mp_context=multiprocessing.get_context('spawn')) as pool:
+                results=list(pool.map(build_asset,*zip(*[(k,p,key) for k,_,p,key,_ in misses])))
+        except (concurrent.futures.BrokenExecutor,OSError,pickle.PicklingError) as e: print(f"Asset cache: no worker pool ({e}), generating inline")
+    if results is None: results=[build_asset(k,p,key) for k,_,p,key,_ in misses]
+    for (kind,name,_,_,path),data in zip(misses,results):
+        arrays[(kind,name)]=data
+        if data is None: continue
+        try: os.makedirs(cache_dir,exist_ok=True); np.save(path+'.tmp.npy',data); os.replace(path+'.tmp.npy',path)
+        except OSError as e: print(f"Asset cache: can't write {path}: {e}")
+    return arrays
+
+def generate_assets(with_sound=True):
+    textures.clear(); sprite_textures.clear()
+    jobs=[('texture',k,v) for k,v in TEXTURE_ASSETS.items()]+[('sprite',k,v) for k,v in SPRITE_ASSETS.items()]+([('sound',k,v) for k,v in SOUND_ASSETS.items()] if with_sound else [])
+    arrays=load_asset_arrays(jobs)
+    for k in TEXTURE_ASSETS: textures[k]=_display_format(pygame.surfarray.make_surface(arrays[('texture',k)]))
+    for k in SPRITE_ASSETS:
+        a=arrays[('sprite',k)]; tex=pygame.Surface(a.shape[:2],pygame.SRCALPHA); pygame.surfarray.blit_array(tex,a[...,:3])
+        pygame.surfarray.pixels_alpha(tex)[:]=a[...,3]; sprite_textures[k]=_display_format(tex,True)
+    if with_sound: return {k:make_sound(arrays[('sound',k)]) for k in SOUND_ASSETS}
+    return {k:DummySound() for k in SOUND_ASSETS}
+
+def draw_hud(screen, font, clock):
+    if not font: return
+    w,h=screen.get_size()
+    hp_c=COLOR_GREEN if player_health>60 else COLOR_YELLOW if player_health>30 else COLOR_RED; hpt=font.render(f"HP:{player_health}",1,hp_c); screen.blit(hpt,(10,h-40))
+    am_c=COLOR_YELLOW if player_clip_ammo>0 else COLOR_RED; ams="RELOADING" if player_is_reloading else f"AMMO:{player_clip_ammo}/{player_ammo}";
+    if player_is_reloading: am_c=COLOR_BLUE;
+    amt=font.render(ams,1,am_c); screen.blit(amt,(w-amt.get_width()-10,h-40))
+    lvl_t=font.render(f"Level:{current_level_index+1}/{MAX_LEVELS}",1,COLOR_WHITE); screen.blit(lvl_t,(w//2-lvl_t.get_width()//2,10))
+    fpst=font.render(f"FPS:{clock.get_fps():.1f}",1,COLOR_GREEN); screen.blit(fpst,(10,10))
 
 def render_game_won_screen(screen, dt, font):
     global credits_scroll_y,last_generator_update,generator_textures
-    current_time=time.time(); screen.fill(COLOR_BLACK)
+    current_time=time.time()
     if current_time-last_generator_update > generator_update_interval:
         last_generator_update=current_time;
         r_col1=(random.randint(0,255), random.randint(0,255), random.randint(0,255))
@@ -320,20 +1361,145 @@ def render_game_won_screen(screen, dt, font):
         p=random.choice(['brick','stone','wood','metal','imp','demon']); new_tex=generate_texture((generator_tex_size,generator_tex_size),r_col1,r_col2,p)
         generator_textures.append(new_tex);
         if len(generator_textures)>generator_grid_size**2*2: generator_textures.pop(0)
-    ti=0
-    for y in range(generator_grid_size):
-        for x in range(generator_grid_size):
-            if ti<len(generator_textures): screen.blit(generator_textures[len(generator_textures)-1-ti],(x*generator_tex_size,y*generator_tex_size))
-            ti+=1
+    screen.blit(layers.get('generator_grid',(len(generator_textures),generator_textures[-1] if generator_textures else None),build_generator_layer),(0,0))
     if font:
         lh=font.get_linesize(); cy=int(credits_scroll_y)
-        for line in credits_text:
-            if line: ts=font.render(line,1,COLOR_WHITE); tr=ts.get_rect(center=(SCREEN_WIDTH//2,cy));
-            if tr.bottom>0 and tr.top<SCREEN_HEIGHT: screen.blit(ts,tr)
+        for ts in layers.get('credits',font,lambda:[font.render(line,1,COLOR_WHITE) if line else None for line in credits_text]):
+            tr=ts.get_rect(center=(SCREEN_WIDTH//2,cy)) if ts else None
+            if tr and tr.bottom>0 and tr.top<SCREEN_HEIGHT: screen.blit(ts,tr)
             cy+=lh
         credits_scroll_y-=credits_scroll_speed*dt; total_h=len(credits_text)*lh
         if credits_scroll_y<-total_h: credits_scroll_y=SCREEN_HEIGHT
 
+# --- Simulation ---
+TICK_RATE = 30 # Simulation ticks per second, independent of the render frame rate
+TICK_DT = 1.0/TICK_RATE
+MAX_CATCHUP_TICKS = 5 # Most ticks run for one rendered frame; a longer stall is dropped rather than replayed
+sim_time = 0.0
+
+def simulate_tick(keys, sounds, dt=TICK_DT):
+    # Advances reload, player movement, contact damage, exit detection and sprite AI by one fixed tick.
+    # Returns 'game_over' or 'game_won' if that happened during the tick.
+    global player_x,player_y,player_angle,player_health,player_ammo,player_clip_ammo,player_is_reloading,player_last_pain_time,sim_time
+    sim_time+=dt; status=None
+    if player_is_reloading and sim_time-player_reload_start_time>=player_reload_time:
+        needed=player_clip_size-player_clip_ammo; load=min(needed,player_ammo); player_clip_ammo+=load; player_ammo-=load; player_is_reloading=False;
+
+    step=player_speed*dt; cos_a,sin_a=math.cos(player_angle),math.sin(player_angle); move_x,move_y=0,0
+    if keys[pygame.K_w] or keys[pygame.K_UP]: move_x+=step*cos_a; move_y+=step*sin_a
+    if keys[pygame.K_s] or keys[pygame.K_DOWN]: move_x-=step*cos_a; move_y-=step*sin_a
+    if keys[pygame.K_a]: move_x+=step*sin_a; move_y-=step*cos_a
+    if keys[pygame.K_d]: move_x-=step*sin_a; move_y+=step*cos_a
+    player_x,player_y=map(float,MAP_GRID.slide(player_x,player_y,move_x,move_y)) # Wall slide
+
+    pr_sq,sr_sq=0.3**2,0.3**2
+    for i in sprites.contacts(player_x,player_y,pr_sq+sr_sq):
+        sprite=sprites[i]
+        if sprite.alive and (player_x-sprite.x)**2+(player_y-sprite.y)**2<pr_sq+sr_sq: # Knockback may have moved us
+            if sprite.static and sprite.texture_index==11 and player_health<player_max_health: player_health=min(player_max_health,player_health+25); sprite.alive=False; sounds.get('pickup',DummySound()).play()
+            elif not sprite.static and sim_time-player_last_pain_time>player_pain_cooldown:
+                player_health-=5; player_last_pain_time=sim_time; sounds.get('player_pain',DummySound()).play()
+                if player_health<=0: status='game_over'
+                dx,dy=player_x-sprite.x,player_y-sprite.y; norm=math.hypot(dx,dy)
+                if norm>1e-6:
+                    kb=0.1; kx,ky=player_x+(dx/norm)*kb,player_y+(dy/norm)*kb
+                    if MAP_GRID.is_walkable(kx,ky): player_x,player_y=kx,ky
+
+    if status is None and MAP_GRID.is_exit(player_x,player_y): sounds.get('level_complete',DummySound()).play(); status='game_won'
+
+    if keys[pygame.K_LEFT] or keys[pygame.K_q]: player_angle-=player_rot_speed*dt
+    if keys[pygame.K_RIGHT] or keys[pygame.K_e]: player_angle+=player_rot_speed*dt
+    player_angle%=(2*math.pi)
+
+    sprites.update(player_x,player_y,dt,pvs=PVS,flow=FLOW)
+    return status
+
+# --- Batched Environment ---
+ACT_FORWARD, ACT_BACK, ACT_LEFT, ACT_RIGHT, ACT_TURN_LEFT, ACT_TURN_RIGHT, ACT_SHOOT, ACT_RELOAD = (1<<k for k in range(8)) # Action bits
+SHOOT_COOLDOWN = 0.2
+ENV_START_AMMO = 50 # Reserve ammo at the start, as in a fresh game
+ENV_REWARD_KILL = 1.0
+ENV_REWARD_EXIT = 10.0
+ENV_REWARD_DAMAGE = -0.05 # Per hit point lost
+
+class BatchedEnv:
+    # N independent games of one level, held as (N,) player arrays and (N, S) sprite arrays and advanced together,
+    # one fixed tick per step(actions) with actions a bitmask of ACT_* per instance. A step covers what main() and
+    # simulate_tick do: shooting and reload, movement with wall slide, pickups, contact damage and knockback, exit,
+    # turning and flow-field sprite AI. Instances that die or reach the exit are reset at the end of the step.
+    # With obs_width > 0 the observation is a (N, obs_width) depth row per instance from the batched raycaster. Sprite AI
+    # isn't PVS-culled as in the game: the sets are built on a worker thread, which would make steps depend on timing.
+    def __init__(self, n, level_index=0, obs_width=0, seed=0):
+        ld=level_data(level_index); self.grid=ld["map"] if isinstance(ld["map"],LevelGrid) else LevelGrid(ld["map"]); self.flow=FlowField(self.grid,count=n)
+        self.start=(*ld["player_start"],ld["player_angle"]); self.table=sprite_table(ld["sprites"]); S=len(self.table)
+        self.n,self.obs_width,self.rng=n,obs_width,np.random.default_rng(seed)
+        self.px,self.py,self.pa,self.t,self.last_pain,self.last_shot,self.reload_start=(np.zeros(n) for _ in range(7))
+        self.health,self.ammo,self.clip=(np.zeros(n,dtype=np.int32) for _ in range(3)); self.reloading=np.zeros(n,dtype=bool)
+        self.sx,self.sy,self.sscale=(np.zeros((n,S)) for _ in range(3)); self.stex=np.zeros((n,S),dtype=np.int16)
+        self.shealth=np.zeros((n,S),dtype=np.int32); self.sstatic,self.salive=np.zeros((n,S),dtype=bool),np.zeros((n,S),dtype=bool)
+        self.reset()
+
+    def reset(self, mask=None):
+        m=slice(None) if mask is None else mask
+        self.px[m],self.py[m],self.pa[m]=self.start; self.t[m]=0.0; self.last_pain[m]=self.last_shot[m]=float('-inf')
+        self.health[m]=player_max_health; self.ammo[m]=ENV_START_AMMO; self.clip[m]=player_clip_size; self.reloading[m]=False
+        tb=self.table; self.sx[m],self.sy[m],self.stex[m],self.sscale[m]=tb['x'],tb['y'],tb['texture_index'],tb['scale']
+        self.sstatic[m],self.shealth[m]=tb['static'].astype(bool),tb['health']; self.salive[m]=True
+        return self.observe()
+
+    def observe(self):
+        if not self.obs_width: return None
+        W,P=self.obs_width,GRID_PAD; cam=2*np.arange(W)/W-1; c,s=np.cos(self.pa)[:,None],np.sin(self.pa)[:,None]
+        rdx,rdy=(c+s*0.66*cam).ravel(),(s-c*0.66*cam).ravel(); gx,gy=np.repeat(self.px+P,W),np.repeat(self.py+P,W)
+        mx,my,side,hit,_=_dda(gx,gy,rdx,rdy,self.grid.opaque); d=_hit_distance(gx,gy,rdx,rdy,mx,my,side); d[~hit]=np.inf
+        return d.reshape(self.n,W).astype(np.float32)
+
+    def step(self, actions):
+        # Returns (observation, reward, done, won); done instances have already been reset
+        a=np.asarray(actions,dtype=np.int64); bit=lambda b:(a&b)!=0; dt=TICK_DT; n=self.n; reward=np.zeros(n); rows=np.arange(n)
+        # Shooting, as main() handles a click: fire if loaded and off cooldown, and any click with reserve ammo starts a reload
+        click=bit(ACT_SHOOT)&~self.reloading; fire=click&(self.clip>0)&(self.t-self.last_shot>=SHOOT_COOLDOWN)
+        if fire.any():
+            i=np.flatnonzero(fire); self.last_shot[i]=self.t[i]; self.clip[i]-=1
+            hit,_=hitscan(self.px[i],self.py[i],self.pa[i],self.sx[i],self.sy[i],valid=self.salive[i]&~self.sstatic[i],grid=self.grid)
+            i,j=i[hit>=0],hit[hit>=0]; self.shealth[i,j]-=self.rng.integers(8,16,len(i)); dead=self.shealth[i,j]<=0; i,j=i[dead],j[dead]
+            self.salive[i,j]=False; self.shealth[i,j]=0; self.stex[i,j]=99; self.sstatic[i,j]=True; np.add.at(reward,i,ENV_REWARD_KILL)
+        start=(click|(bit(ACT_RELOAD)&(self.clip<player_clip_size)))&~self.reloading&(self.ammo>0)
+        self.reloading|=start; self.reload_start[start]=self.t[start]
+        self.t+=dt
+        done_rl=self.reloading&(self.t-self.reload_start>=player_reload_time); load=np.minimum(player_clip_size-self.clip,self.ammo)*done_rl
+        self.clip+=load; self.ammo-=load; self.reloading&=~done_rl
+        # Movement with wall slide
+        step=player_speed*dt; c,s=np.cos(self.pa),np.sin(self.pa); f=bit(ACT_FORWARD).astype(int)-bit(ACT_BACK); side=bit(ACT_LEFT).astype(int)-bit(ACT_RIGHT)
+        self.px,self.py=self.grid.slide(self.px,self.py,step*(f*c+side*s),step*(f*s-side*c))
+        # Contacts in sprite order, as simulate_tick walks them; knockback can move the player off later sprites. The pain
+        # cooldown allows one 0.1 knockback per instance per tick, so only sprites within reach+0.1 of some instance can touch
+        hp0=self.health.copy(); d2=(self.px[:,None]-self.sx)**2+(self.py[:,None]-self.sy)**2
+        for j in np.flatnonzero((self.salive&(d2<(math.sqrt(0.18)+0.1)**2)).any(0)):
+            dx,dy=self.px-self.sx[:,j],self.py-self.sy[:,j]; d2=dx*dx+dy*dy; touch=self.salive[:,j]&(d2<0.18)
+            pick=touch&self.sstatic[:,j]&(self.stex[:,j]==11)&(self.health<player_max_health)
+            self.health=np.where(pick,np.minimum(player_max_health,self.health+25),self.health); self.salive[pick,j]=False
+            hurt=touch&~self.sstatic[:,j]&(self.t-self.last_pain>player_pain_cooldown); self.health-=5*hurt; self.last_pain[hurt]=self.t[hurt]
+            norm=np.sqrt(d2); push=hurt&(norm>1e-6)
+            with np.errstate(divide='ignore',invalid='ignore'): kx,ky=self.px+dx/norm*0.1,self.py+dy/norm*0.1
+            push&=self.grid.is_walkable(np.where(push,kx,self.px),np.where(push,ky,self.py))
+            self.px,self.py=np.where(push,kx,self.px),np.where(push,ky,self.py)
+        reward+=ENV_REWARD_DAMAGE*np.maximum(hp0-self.health,0); dead=self.health<=0
+        won=~dead&self.grid.is_exit(self.px,self.py); reward+=ENV_REWARD_EXIT*won
+        self.pa=(self.pa+player_rot_speed*dt*(bit(ACT_TURN_RIGHT).astype(int)-bit(ACT_TURN_LEFT)))%(2*math.pi)
+        # Sprite AI: live enemies in 1.5..8 units follow that instance's flow field, or head straight for the player without a path
+        px,py=self.px[:,None],self.py[:,None]; dist=np.hypot(px-self.sx,py-self.sy); move=self.salive&~self.sstatic&(dist>1.5)&(dist<8.0)
+        if move.any():
+            self.flow.update(np.floor(self.px),np.floor(self.py)); gx,gy,_=self.flow.steer(self.sx,self.sy,px,py,rows[:,None])
+            dx,dy=gx-self.sx,gy-self.sy; d=np.hypot(dx,dy)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                speed=SPRITE_SPEED*dt*(1+self.rng.uniform(-0.2,0.2,move.shape)); nx,ny=self.sx+dx/d*speed,self.sy+dy/d*speed
+            move&=self.grid.is_walkable(np.where(move,nx,self.sx),np.where(move,ny,self.sy))
+            self.sx,self.sy=np.where(move,nx,self.sx),np.where(move,ny,self.sy)
+        done=dead|won
+        if done.any(): self.reset(done)
+        return self.observe(),reward,done,won
+
 # --- Main Game ---
 def main():
     global player_x, player_y, player_angle, sprites, current_level_index
@@ -347,38 +1513,23 @@ def main():
     screen=pygame.display.set_mode((SCREEN_WIDTH,SCREEN_HEIGHT)); pygame.display.set_caption("Pygame Raycaster")
     clock=pygame.time.Clock(); hud_font=pygame.font.Font(None,30) if pygame.font.get_init() else None
     msg_font=pygame.font.Font(None,40) if pygame.font.get_init() else None; credits_font=pygame.font.Font(None,28) if pygame.font.get_init() else hud_font
-    sounds={} # Initialize sounds locally
     game_msg, game_msg_timer = "", 0 # Initialize messages locally
 
-    print("Generating assets..."); textures.clear(); sprite_textures.clear()
-    textures[T_BRICK]=generate_texture((TEX_WIDTH,TEX_HEIGHT),(150,50,50),(100,30,30),'brick'); textures[T_STONE]=generate_texture((TEX_WIDTH,TEX_HEIGHT),(100,100,100),(70,70,70),'stone')
-    textures[T_WOOD]=generate_texture((TEX_WIDTH,TEX_HEIGHT),(180,120,80),(130,90,50),'wood'); textures[T_METAL]=generate_texture((TEX_WIDTH,TEX_HEIGHT),(80,80,150),(50,50,100),'metal')
-    textures[T_EXIT]=generate_texture((TEX_WIDTH,TEX_HEIGHT),(0,0,50),(200,200,255),'exit'); sprite_textures[10]=generate_alpha_texture((TEX_WIDTH,TEX_HEIGHT),None,None,'imp')
-    sprite_textures[11]=generate_alpha_texture((TEX_WIDTH,TEX_HEIGHT),None,None,'pickup_health'); sprite_textures[12]=generate_alpha_texture((TEX_WIDTH,TEX_HEIGHT),None,None,'demon')
-    sprite_textures[99]=generate_alpha_texture((TEX_WIDTH,TEX_HEIGHT),None,COLOR_DARK_RED,'dead_body')
-    if mixer_initialized:
-        sounds['shoot']=generate_sound(frequency=150,duration=0.15,volume=0.15,waveform='sawtooth',noise_factor=0.5,attack=0.005,decay=0.1,release=0.04)
-        sounds['reload']=generate_sound(frequency=200,duration=0.4,volume=0.2,waveform='noise',noise_factor=0.3,attack=0.05,decay=0.3)
-        sounds['no_ammo']=generate_sound(frequency=600,duration=0.08,volume=0.1,waveform='square',attack=0.01,decay=0.06)
-        sounds['hit_wall']=generate_sound(frequency=800,duration=0.05,volume=0.1,waveform='noise',noise_factor=0.8,attack=0.002,decay=0.04)
-        sounds['enemy_pain']=generate_sound(frequency=450,duration=0.2,volume=0.2,waveform='square',noise_factor=0.3,pitch_bend=-0.2)
-        sounds['enemy_death']=generate_sound(frequency=150,duration=0.6,volume=0.25,waveform='noise',fm_freq=30,fm_amp=80,noise_factor=0.6)
-        sounds['level_complete']=generate_sound(frequency=440,duration=1.0,volume=0.3,waveform='sine',attack=0.01,decay=0.8,fm_freq=5,fm_amp=20)
-        sounds['pickup']=generate_sound(frequency=660,duration=0.2,volume=0.2,waveform='triangle',attack=0.01,decay=0.15)
-        sounds['player_pain']=generate_sound(frequency=300,duration=0.3,volume=0.25,waveform='sine',pitch_bend=-0.5,noise_factor=0.1)
-    else: sounds={k:DummySound() for k in ['shoot','reload','no_ammo','hit_wall','enemy_pain','enemy_death','level_complete','pickup','player_pain']}
+    print("Generating assets..."); sounds=generate_assets(mixer_initialized)
     print("Assets generated.")
 
     current_level_index=0;
     if not load_level(current_level_index): print("FATAL: No levels."); pygame.quit(); sys.exit()
-    # play_level_music(current_level_index, sounds)
+    play_level_music(current_level_index, sounds)
 
-    running=True; show_map=False; game_over=False; game_won=False
-    lp_pain_t=0; p_pain_cd=0.5; depth_buffer=np.full(SCREEN_WIDTH,float('inf'),dtype=float)
-    shoot_cd=0.2; last_shot_t=0; credits_scroll_y=SCREEN_HEIGHT; last_gen_update=0
+    running=True; show_map=False; game_over=False; game_won=False; presented=None # Static screen currently on display
+    store=TextureStore(textures,sprite_textures); dynres=ResolutionController(scale=RENDER_SCALE or 1.0); frame_type=PalettedFrameBuffer if PALETTED else FrameBuffer
+    if PALETTED: store.quantize()
+    frame=frame_type(*render_size(dynres.scale),store,RENDER_BANDS); accumulator=0.0; prev_pose=(player_x,player_y,player_angle)
+    shoot_cd=SHOOT_COOLDOWN; last_shot_t=-shoot_cd; credits_scroll_y=SCREEN_HEIGHT; last_gen_update=0; prof=FrameProfiler(); small_font=pygame.font.Font(None,20) if pygame.font.get_init() else None
 
     while running:
-        dt=clock.tick(FPS)/1000.0; dt=min(dt,0.1); current_time=time.time()
+        dt=clock.tick(FPS)/1000.0; dt=min(dt,0.25); current_time=time.time(); prof.begin_frame(); work_start=time.perf_counter()
 
         # Events
         for event in pygame.event.get():
@@ -387,182 +1538,174 @@ def main():
                 if event.key==pygame.K_ESCAPE: running=False
                 if not game_won and not game_over:
                     if event.key==pygame.K_m: show_map=not show_map
+                    if event.key==pygame.K_n: prof.toggle() # Profiler overlay
+                    if event.key==pygame.K_b and prof.enabled: prof.dump_csv(time.strftime("profile_%Y%m%d_%H%M%S.csv"))
                     if event.key==pygame.K_r and not player_is_reloading and player_clip_ammo<player_clip_size and player_ammo>0:
-                        player_is_reloading=True; player_reload_start_time=current_time; sounds.get('reload',DummySound()).play()
+                        player_is_reloading=True; player_reload_start_time=sim_time; sounds.get('reload',DummySound()).play()
             if event.type==pygame.MOUSEBUTTONDOWN and event.button==1 and not player_is_reloading and not game_over and not game_won:
                 if player_clip_ammo>0:
-                    if current_time-last_shot_t>=shoot_cd:
-                        last_shot_t=current_time; player_clip_ammo-=1; sounds.get('shoot',DummySound()).play()
-                        dirX_s,dirY_s=math.cos(player_angle),math.sin(player_angle); dist,max_d,step=0.05,20.0,0.05; hit_sp,hit_w=None,False
-                        while dist<max_d:
-                            cx,cy=player_x+dirX_s*dist,player_y+dirY_s*dist; mx,my=int(cx),int(cy)
-                            if not(0<=mx<MAP_WIDTH and 0<=my<MAP_HEIGHT): hit_w=True; break
-                            if MAP_GRID[my][mx]>T_EMPTY and MAP_GRID[my][mx]!=T_EXIT: hit_w=True; break
-                            hits=[]
-                            for i,sp in enumerate(sprites):
-                                if sp.alive and not sp.static: d_sq=(cx-sp.x)**2+(cy-sp.y)**2;
-                                if d_sq<0.3**2: hits.append((d_sq,i))
-                            if hits: hits.sort(); hit_sp=sprites[hits[0][1]]; break
-                            dist+=step
+                    if sim_time-last_shot_t>=shoot_cd:
+                        last_shot_t=sim_time; player_clip_ammo-=1; sounds.get('shoot',DummySound()).play()
+                        prof.mark('events'); hit_i,_=sprites.hitscan(player_x,player_y,player_angle); hit_sp=sprites[int(hit_i[0])] if hit_i[0]>=0 else None; prof.mark('hitscan')
                         if hit_sp and hit_sp.take_damage(random.randint(8,15),sounds): hit_sp.texture_index=99; hit_sp.static=True
                 else: sounds.get('no_ammo',DummySound()).play();
-                if not player_is_reloading and player_ammo>0: player_is_reloading=True; player_reload_start_time=current_time; sounds.get('reload',DummySound()).play()
+                if not player_is_reloading and player_ammo>0: player_is_reloading=True; player_reload_start_time=sim_time; sounds.get('reload',DummySound()).play()
+
+        if music_channel: music_channel.pump() # Never blocks; an empty queue just means the next block isn't ready yet
+        prof.mark('events')
 
         # State Updates
         if game_won: render_game_won_screen(screen,dt,credits_font if credits_font else hud_font); pygame.display.flip(); continue
-        elif game_over:
-             screen.fill(COLOR_BLACK)
-             if msg_font:
-                 msg=msg_font.render("GAME OVER",1,COLOR_RED); r=msg.get_rect(center=(SCREEN_WIDTH//2,SCREEN_HEIGHT//2-40)); screen.blit(msg,r)
-                 ex=msg_font.render("Press ESC to Exit",1,COLOR_WHITE); r=ex.get_rect(center=(SCREEN_WIDTH//2,SCREEN_HEIGHT//2+40)); screen.blit(ex,r)
-             pygame.display.flip(); continue
+        elif game_over: # Static screen: drawn and presented once, then every later frame has nothing dirty
+             dirty=[]
+             if presented!='game_over': screen.blit(layers.get('game_over',msg_font,lambda:build_game_over_layer(msg_font)),(0,0)); dirty=[screen.get_rect()]; presented='game_over'
+             pygame.display.update(dirty); continue
         else: # Normal Play
-            if player_is_reloading and current_time-player_reload_start_time>=player_reload_time:
-                needed=player_clip_size-player_clip_ammo; load=min(needed,player_ammo); player_clip_ammo+=load; player_ammo-=load; player_is_reloading=False;
-
-            keys=pygame.key.get_pressed(); cos_a,sin_a=math.cos(player_angle),math.sin(player_angle); move_x,move_y=0,0
-            if keys[pygame.K_w] or keys[pygame.K_UP]: move_x+=player_speed*cos_a; move_y+=player_speed*sin_a
-            if keys[pygame.K_s] or keys[pygame.K_DOWN]: move_x-=player_speed*cos_a; move_y-=player_speed*sin_a
-            if keys[pygame.K_a]: move_x+=player_speed*sin_a; move_y-=player_speed*cos_a
-            if keys[pygame.K_d]: move_x-=player_speed*sin_a; move_y+=player_speed*cos_a
-            npx,npy=player_x+move_x,player_y+move_y; mtx,mty=int(npx),int(npy); target_tile=T_EMPTY
-            if 0<=mtx<MAP_WIDTH and 0<=mty<MAP_HEIGHT: target_tile=MAP_GRID[mty][mtx]
-            is_wall=target_tile>T_EMPTY and target_tile!=T_EXIT
-
-            if not is_wall: player_x,player_y=npx,npy
-            else: # Wall slide
-                check_x_map_x = int(player_x + move_x)
-                check_x_map_y = int(player_y)
-                if 0 <= check_x_map_x < MAP_WIDTH and 0 <= check_x_map_y < MAP_HEIGHT and MAP_GRID[check_x_map_y][check_x_map_x] <= T_EMPTY:
-                    player_x += move_x
-
-                check_y_map_x = int(player_x)
-                check_y_map_y = int(player_y + move_y)
-                if 0 <= check_y_map_x < MAP_WIDTH and 0 <= check_y_map_y < MAP_HEIGHT and MAP_GRID[check_y_map_y][check_y_map_x] <= T_EMPTY:
-                    player_y += move_y
-
-            pr_sq,sr_sq=0.3**2,0.3**2
-            for sprite in sprites:
-                 if sprite.alive:
-                     d_sq=(player_x-sprite.x)**2+(player_y-sprite.y)**2
-                     if d_sq<pr_sq+sr_sq:
-                          if sprite.static and sprite.texture_index==11 and player_health<player_max_health: player_health=min(player_max_health,player_health+25); sprite.alive=False; sounds.get('pickup',DummySound()).play()
-                          elif not sprite.static and current_time-lp_pain_t>p_pain_cd:
-                              player_health-=5; lp_pain_t=current_time; sounds.get('player_pain',DummySound()).play()
-                              if player_health<=0: game_over=True; print("GAME OVER")
-                              dx,dy=player_x-sprite.x,player_y-sprite.y; norm=math.hypot(dx,dy)
-                              if norm>1e-6: kb=0.1; kx,ky=player_x+(dx/norm)*kb,player_y+(dy/norm)*kb; kmx,kmy=int(kx),int(ky);
-                              if 0<=kmx<MAP_WIDTH and 0<=kmy<MAP_HEIGHT and MAP_GRID[kmy][kmx]==T_EMPTY: player_x,player_y=kx,ky
-
-            mcx,mcy=int(player_x),int(player_y)
-            if 0<=mcx<MAP_WIDTH and 0<=mcy<MAP_HEIGHT and MAP_GRID[mcy][mcx]==T_EXIT: sounds.get('level_complete',DummySound()).play(); game_won=True; print("YOU WON!"); game_message="YOU ARE VICTORIOUS!"; game_message_timer=current_time+5.0;
-            if music_channel: music_channel.stop()
-
-            if keys[pygame.K_LEFT] or keys[pygame.K_q]: player_angle-=player_rot_speed
-            if keys[pygame.K_RIGHT] or keys[pygame.K_e]: player_angle+=player_rot_speed
-            player_angle%=(2*math.pi)
-
-            for sprite in sprites: sprite.update(player_x,player_y,dt)
+            keys=pygame.key.get_pressed(); accumulator+=dt; ticks=0
+            while accumulator>=TICK_DT and not (game_over or game_won):
+                if ticks==MAX_CATCHUP_TICKS: accumulator=min(accumulator,TICK_DT); break # Drop the backlog instead of spiralling
+                prev_pose=(player_x,player_y,player_angle); sprites.snapshot(); status=simulate_tick(keys,sounds); accumulator-=TICK_DT; ticks+=1
+                if status=='game_over': game_over=True; print("GAME OVER")
+                elif status=='game_won': game_won=True; print("YOU WON!")
+            prof.mark('update')
 
-            # --- Rendering ---
-            screen.fill(COLOR_FLOOR); pygame.draw.rect(screen,COLOR_CEILING,(0,0,SCREEN_WIDTH,SCREEN_HEIGHT//2))
-            dirX,dirY=math.cos(player_angle),math.sin(player_angle); planeX,planeY=math.sin(player_angle)*0.66,-math.cos(player_angle)*0.66
-            depth_buffer.fill(float('inf'))
+            # Interpolate between the last two ticks
+            alpha=min(accumulator/TICK_DT,1.0); rx,ry=prev_pose[0]+(player_x-prev_pose[0])*alpha,prev_pose[1]+(player_y-prev_pose[1])*alpha
+            ra=(prev_pose[2]+((player_angle-prev_pose[2]+math.pi)%(2*math.pi)-math.pi)*alpha)%(2*math.pi)
 
+            # --- Rendering ---
             # Walls
-            for x in range(SCREEN_WIDTH):
-                camX=2*x/SCREEN_WIDTH-1; rdx,rdy=dirX+planeX*camX,dirY+planeY*camX; mx,my=int(player_x),int(player_y)
-                ddx=abs(1/rdx) if rdx else float('inf'); ddy=abs(1/rdy) if rdy else float('inf')
-                sx,sdx=(-1,(player_x-mx)*ddx) if rdx<0 else (1,(mx+1.0-player_x)*ddx); sy,sdy=(-1,(player_y-my)*ddy) if rdy<0 else (1,(my+1.0-player_y)*ddy)
-                hit,side,steps,max_steps=0,0,0,60
-                while hit==0 and steps<max_steps:
-                    if sdx<sdy: sdx+=ddx; mx+=sx; side=0
-                    else: sdy+=ddy; my+=sy; side=1
-                    steps+=1;
-                    if not(0<=mx<MAP_WIDTH and 0<=my<MAP_HEIGHT): hit=1; break
-                    if MAP_GRID[my][mx]>T_EMPTY: hit=1
-                pwd=float('inf')
-                if hit and steps<max_steps:
-                    try:
-                        if side == 0: pwd = ((mx - player_x + (1 - sx) / 2) / rdx)
-                        else: pwd = ((my - player_y + (1 - sy) / 2) / rdy)
-                    except ZeroDivisionError: pass
-                if pwd<=1e-4: pwd=float('inf')
-                depth_buffer[x]=pwd; lh=int(SCREEN_HEIGHT/pwd) if pwd!=float('inf') else 0; ds,de=max(0,-lh//2+SCREEN_HEIGHT//2),min(SCREEN_HEIGHT,lh//2+SCREEN_HEIGHT//2)
-                if lh>0 and ds<de:
-                    map_valid=(0<=mx<MAP_WIDTH and 0<=my<MAP_HEIGHT); tex_n=MAP_GRID[my][mx] if map_valid and hit else 1; tex=textures.get(tex_n)
-                    if tex:
-                         wx=(player_y+pwd*rdy) if side==0 else (player_x+pwd*rdx); wx-=math.floor(wx); tx=int(wx*TEX_WIDTH);
-                         if side==0 and rdx>0: tx=TEX_WIDTH-tx-1
-                         if side==1 and rdy<0: tx=TEX_WIDTH-tx-1
-                         tx=max(0,min(TEX_WIDTH-1,tx)); th=de-ds
-                         if th>0:
-                             try: sc=tex.subsurface(tx,0,1,TEX_HEIGHT); scol=pygame.transform.scale(sc,(1,th)); sh=max(0.2,min(1.0,1.0/(1+pwd*0.1)))*(0.7 if side==1 else 1.0); shc=(int(sh*255),)*3; shcol=scol.copy(); shcol.fill(shc,special_flags=pygame.BLEND_MULT); screen.blit(shcol,(x,ds))
-                             except ValueError: pass
+            frame.render_walls(rx,ry,ra,COLOR_CEILING,COLOR_FLOOR); prof.mark('walls')
 
             # Sprites
-            for sprite in sprites: sprite.dist_sq=(player_x-sprite.x)**2+(player_y-sprite.y)**2
-            sprites.sort(key=lambda s:s.dist_sq,reverse=True)
-            for sprite in sprites:
-                if not sprite.alive and sprite.texture_index!=99: continue
-                tex=sprite_textures.get(sprite.texture_index);
-                if not tex: continue
-                sxr,syr=sprite.x-player_x,sprite.y-player_y; inv_det_d=(planeX*dirY-dirX*planeY);
-                if abs(inv_det_d)<1e-9: continue
-                inv_det=1.0/inv_det_d; tx=inv_det*(dirY*sxr-dirX*syr); ty=inv_det*(-planeY*sxr+planeX*syr)
-                if ty<=0.1: continue
-                ssx=int((SCREEN_WIDTH/2)*(1+tx/ty)); tex_h,tex_w=tex.get_height(),tex.get_width()
-                sh_raw=(SCREEN_HEIGHT/ty)*sprite.scale; sh=abs(int(sh_raw)); asp=(tex_w/tex_h) if tex_h>0 else 1; sw=abs(int(sh_raw*asp))
-                dsy,dey=SCREEN_HEIGHT//2-sh//2,SCREEN_HEIGHT//2+sh//2; dsx,dex=ssx-sw//2,ssx+sw//2
-                dsyc,deyc=max(0,dsy),min(SCREEN_HEIGHT,dey); dsxc,dexc=max(0,dsx),min(SCREEN_WIDTH,dex)
-                for stripe in range(dsxc,dexc):
-                      if ty<depth_buffer[stripe]:
-                           if sw<=0: continue
-                           tx_x=int((stripe-dsx)*tex_w/sw); tx_x=max(0,min(tex_w-1,tx_x))
-                           th=deyc-dsyc
-                           if th>0 and sh>0:
-                                try:
-                                    sc=tex.subsurface(tx_x,0,1,tex_h); scol=pygame.transform.scale(sc,(1,th)); shd=max(0.3,min(1.0,1.0/(1+ty*0.15)))
-                                    shcol=scol.copy(); shc=(int(shd*255),)*3; shcol.fill(shc,special_flags=pygame.BLEND_MULT)
-                                    if tex.get_colorkey(): shcol.set_colorkey(tex.get_colorkey())
-                                    screen.blit(shcol,(stripe,dsyc))
-                                except ValueError: pass
+            shown=sprites.drawable(PVS,rx,ry); sx,sy=sprites.interpolated(shown,alpha); frame.render_sprites(rx,ry,ra,sx,sy,sprites.texture_index[shown],sprites.scale[shown]); prof.mark('sprites')
+            frame.present(screen); prof.mark('present') # Framebuffer blit, and the upscale when rendering below window size
 
             # HUD
-            if hud_font:
-                hp_c=COLOR_GREEN if player_health>60 else COLOR_YELLOW if player_health>30 else COLOR_RED; hpt=hud_font.render(f"HP:{player_health}",1,hp_c); screen.blit(hpt,(10,SCREEN_HEIGHT-40))
-                am_c=COLOR_YELLOW if player_clip_ammo>0 else COLOR_RED; ams="RELOADING" if player_is_reloading else f"AMMO:{player_clip_ammo}/{player_ammo}";
-                if player_is_reloading: am_c=COLOR_BLUE;
-                amt=hud_font.render(ams,1,am_c); screen.blit(amt,(SCREEN_WIDTH-amt.get_width()-10,SCREEN_HEIGHT-40))
-                lvl_t=hud_font.render(f"Level:{current_level_index+1}/{MAX_LEVELS}",1,COLOR_WHITE); screen.blit(lvl_t,(SCREEN_WIDTH//2-lvl_t.get_width()//2,10))
-                fpst=hud_font.render(f"FPS:{clock.get_fps():.1f}",1,COLOR_GREEN); screen.blit(fpst,(10,10))
+            draw_hud(screen,hud_font,clock)
 
             # Messages
             if game_msg and msg_font and current_time<game_msg_timer: msgs=msg_font.render(game_msg,1,COLOR_YELLOW); msgr=msgs.get_rect(center=(SCREEN_WIDTH//2,SCREEN_HEIGHT//3)); screen.blit(msgs,msgr)
             elif game_msg and current_time>=game_msg_timer: game_msg="" # Clear message
 
             # Crosshair
-            cs=8; cx,cy=SCREEN_WIDTH//2,SCREEN_HEIGHT//2; pygame.draw.line(screen,COLOR_WHITE,(cx-cs,cy),(cx+cs,cy),1); pygame.draw.line(screen,COLOR_WHITE,(cx,cy-cs),(cx,cy+cs),1)
+            screen.blit(layers.get('crosshair',CROSSHAIR_SIZE,build_crosshair_layer),(SCREEN_WIDTH//2-CROSSHAIR_SIZE,SCREEN_HEIGHT//2-CROSSHAIR_SIZE))
 
             # Debug Map
             if show_map:
-                ms=8; mox=SCREEN_WIDTH-(MAP_WIDTH*ms)-10; moy=10; mr=pygame.Rect(mox-5,moy-5,MAP_WIDTH*ms+10,MAP_HEIGHT*ms+10)
-                msurf=pygame.Surface(mr.size,pygame.SRCALPHA); msurf.fill((20,20,20,180)); screen.blit(msurf,mr.topleft)
-                for y,row in enumerate(MAP_GRID):
-                    for x,tile in enumerate(row): c=(80,80,80); t=textures.get(tile);
-                    if t: c=t.get_at((0,0)) if tile!=T_EXIT else (0,255,255); pygame.draw.rect(screen,c,(mox+x*ms,moy+y*ms,ms-1,ms-1))
+                # Whole map when it fits, otherwise the MINIMAP_TILES square around the player
+                # The tiles are a cached layer rebuilt when the level, the map or the window changes; markers go on top
+                ms=MINIMAP_CELL; mw,mh=min(MAP_WIDTH,MINIMAP_TILES),min(MAP_HEIGHT,MINIMAP_TILES)
+                wx0,wy0=min(max(int(player_x)-mw//2,0),MAP_WIDTH-mw),min(max(int(player_y)-mh//2,0),MAP_HEIGHT-mh)
+                mox=SCREEN_WIDTH-(mw*ms)-10-wx0*ms; moy=10-wy0*ms
+                screen.blit(layers.get('minimap',(MAP_GRID,MAP_GRID.version,wx0,wy0),lambda:build_minimap_layer(MAP_GRID.window(wx0,wy0,wx0+mw,wy0+mh))),(mox+wx0*ms-5,moy+wy0*ms-5))
                 pxm,pym=mox+int(player_x*ms),moy+int(player_y*ms); pygame.draw.circle(screen,COLOR_GREEN,(pxm,pym),ms//2)
                 ll=ms; cos_a,sin_a=math.cos(player_angle),math.sin(player_angle); ex,ey=pxm+ll*cos_a,pym+ll*sin_a; pygame.draw.line(screen,COLOR_GREEN,(pxm,pym),(ex,ey),1)
-                for s in sprites:
+                for s in (sprites[i] for i in sprites.near(wx0+mw/2,wy0+mh/2,max(mw,mh)/2).tolist()):
                     if s.alive or s.texture_index==99: sxm,sym=mox+int(s.x*ms),moy+int(s.y*ms); sc=COLOR_DARK_RED if s.alive and not s.static else (80,0,0) if not s.alive else COLOR_BLUE; pygame.draw.circle(screen,sc,(sxm,sym),ms//3)
 
-            pygame.display.flip() # Final flip for the normal game state
+            prof.draw_overlay(screen,small_font); prof.mark('hud')
+            pygame.display.flip(); prof.mark('flip'); prof.end_frame() # Final flip for the normal game state
+
+            # Resize the internal resolution when the frame work time drifts off target
+            if RENDER_SCALE is None:
+                dynres.record((time.perf_counter()-work_start)*1000.0); scale=dynres.update(time.perf_counter())
+                if scale is not None:
+                    frame.close(); frame=frame_type(*render_size(scale),store,RENDER_BANDS)
+                    print(f"Render resolution {frame.width}x{frame.height} (p95 {dynres.last_p95:.1f}ms)")
 
     # --- Cleanup ---
+    if music_channel: music_channel.stop()
     if mixer_initialized: pygame.mixer.quit()
     pygame.font.quit(); pygame.quit(); sys.exit()
 
+# --- Benchmark ---
+BENCH_RESOLUTIONS = [(320, 240), (640, 480)]
+BENCH_SPRITE_COUNTS = [0, 100]
+BENCH_PATHS = ['spin', 'corridor', 'sweep']
+BENCH_BANDS = [1] # Render band (thread) counts; pass several to see how banded rendering scales
+BENCH_FRAMES = 120
+BENCH_WARMUP = 5 # Untimed frames per run so sprite caches are warm
+BENCH_STAGES = ('sim', 'walls', 'sprites', 'present', 'hud')
+
+def camera_path(name, frames):
+    # Scripted (x, y, angle) poses over the loaded level
+    sx,sy,a0=LEVEL_START
+    if name=='spin': return [(sx,sy,a0+2*math.pi*i/frames) for i in range(frames)]
+    best=(0,0,0,0) # Longest horizontal run of walkable tiles (the first in row order on ties), walked there and back
+    for y0,tiles in MAP_GRID.strips():
+        edges=np.diff(np.pad(tiles==T_EMPTY,((0,0),(1,1))).astype(np.int8),axis=1); (ys,x0s),(_,x1s)=np.nonzero(edges>0),np.nonzero(edges<0)
+        if len(x0s) and (x1s-x0s).max()>best[0]: k=np.argmax(x1s-x0s); best=(int(x1s[k]-x0s[k]),int(x0s[k]),int(x1s[k]),y0+int(ys[k]))
+    _,x0,x1,y=best; poses=[]
+    for i in range(frames):
+        u=1-abs(2*i/frames-1); a=0.0 if i<frames//2 else math.pi
+        if name=='sweep': a+=0.8*math.sin(4*math.pi*i/frames)
+        poses.append((x0+0.5+u*(x1-x0-1),y+0.5,a))
+    return poses
+
+def add_bench_sprites(count, seed=1234):
+    # Enemies on random walkable tiles: one strip pass counts them, the draws pick walkable tile numbers, a second pass finds them
+    rng=random.Random(seed); counts=[int((tiles==T_EMPTY).sum()) for _,tiles in MAP_GRID.strips()]; draws=[]
+    for _ in range(count): k=rng.randrange(sum(counts)); tex=rng.choice((10,12)); draws.append((k,tex,rng.uniform(0.2,0.8),rng.uniform(0.2,0.8)))
+    ks=np.array([d[0] for d in draws],dtype=np.int64); xs,ys=np.zeros(count),np.zeros(count); base=0
+    for (y0,tiles),n in zip(MAP_GRID.strips(),counts):
+        mine=(ks>=base)&(ks<base+n)
+        if mine.any(): ty,tx=np.nonzero(tiles==T_EMPTY); xs[mine],ys[mine]=tx[ks[mine]-base],y0+ty[ks[mine]-base]
+        base+=n
+    for x,y,(_,tex,u,v) in zip(xs,ys,draws): sprites.add(x+u,y+v,tex,1.2 if tex==12 else 1.0,False,40)
+
+def run_benchmark(out_path, frames=BENCH_FRAMES, resolutions=BENCH_RESOLUTIONS, sprite_counts=BENCH_SPRITE_COUNTS, paths=BENCH_PATHS, band_counts=BENCH_BANDS):
+    # Replays camera paths over every level under SDL's dummy drivers and writes per-stage frame time percentiles (ms) as JSON
+    global player_x,player_y,player_angle,current_level_index
+    os.environ['SDL_VIDEODRIVER']='dummy'; os.environ['SDL_AUDIODRIVER']='dummy'
+    pygame.init(); pygame.font.init(); pygame.display.set_mode(resolutions[0]); generate_assets(False)
+    store=TextureStore(textures,sprite_textures); font=pygame.font.Font(None,30); clock=pygame.time.Clock(); runs=[]
+    if PALETTED: store.quantize()
+    for (w,h),bands in [(r,b) for r in resolutions for b in band_counts]:
+        screen=pygame.display.set_mode((w,h)); frame=(PalettedFrameBuffer if PALETTED else FrameBuffer)(w,h,store,bands)
+        for level in range(MAX_LEVELS):
+            for count in sprite_counts:
+                for path in paths:
+                    current_level_index=level; load_level(level); add_bench_sprites(count); poses=camera_path(path,frames)
+                    times=np.zeros((frames,len(BENCH_STAGES)))
+                    for f,(x,y,a) in enumerate(poses[:BENCH_WARMUP]+poses):
+                        player_x,player_y,player_angle=x,y,a; t0=time.perf_counter()
+                        sprites.update(x,y,TICK_DT,pvs=PVS,flow=FLOW); sprites.contacts(x,y,0.18); sprites.hitscan(x,y,a); t1=time.perf_counter()
+                        frame.render_walls(x,y,a,COLOR_CEILING,COLOR_FLOOR); t2=time.perf_counter()
+                        shown=sprites.drawable(PVS,x,y); frame.render_sprites(x,y,a,sprites.x[shown],sprites.y[shown],sprites.texture_index[shown],sprites.scale[shown]); t3=time.perf_counter()
+                        frame.present(screen); t4=time.perf_counter(); draw_hud(screen,font,clock); pygame.display.flip(); t5=time.perf_counter()
+                        if f>=BENCH_WARMUP: times[f-BENCH_WARMUP]=(t1-t0,t2-t1,t3-t2,t4-t3,t5-t4)
+                    times*=1000; stats={}
+                    for k,name in enumerate(BENCH_STAGES+('frame',)):
+                        col=times[:,k] if k<len(BENCH_STAGES) else times.sum(axis=1); p50,p95,p99=np.percentile(col,[50,95,99])
+                        stats[name]={"p50":round(p50,3),"p95":round(p95,3),"p99":round(p99,3),"mean":round(col.mean(),3)}
+                    runs.append({"level":level,"path":path,"resolution":[w,h],"bands":bands,"paletted":PALETTED,"sprites":len(sprites),"frames":frames,"stages":stats})
+                    print(f"L{level} {path:8s} {w}x{h} bands={bands} sprites={len(sprites):4d}  frame p50={stats['frame']['p50']:.2f}ms p95={stats['frame']['p95']:.2f}ms p99={stats['frame']['p99']:.2f}ms")
+        frame.close()
+    result={"meta":{"timestamp":time.strftime("%Y-%m-%dT%H:%M:%S"),"python":sys.version.split()[0],"numpy":np.__version__,"pygame":pygame.version.ver,
+                    "platform":sys.platform,"units":"ms"},"runs":runs}
+    with open(out_path,'w') as f: json.dump(result,f,indent=1)
+    print(f"Benchmark results written to {out_path}"); pygame.quit()
+    return result
+
 if __name__ == '__main__':
+    import argparse
+    ap=argparse.ArgumentParser(description="Pygame Raycaster")
+    ap.add_argument('--benchmark',metavar='OUT_JSON',nargs='?',const='bench_results.json',help="run the headless benchmark and write results to OUT_JSON")
+    ap.add_argument('--bench-frames',type=int,default=BENCH_FRAMES,help="frames per benchmark run")
+    ap.add_argument('--bench-bands',default=",".join(map(str,BENCH_BANDS)),help="comma-separated render band counts to benchmark, e.g. 1,2,4,8")
+    ap.add_argument('--bands',type=int,default=RENDER_BANDS,help="render the screen in this many parallel column bands")
+    ap.add_argument('--render-scale',type=float,default=RENDER_SCALE,help="render walls and sprites at this fraction of the window size instead of scaling dynamically")
+    ap.add_argument('--paletted',action='store_true',help="render with a 256-colour palette and a precomputed light colormap")
+    ap.add_argument('--level',nargs='+',metavar='LEVEL_FILE',help="play (or benchmark) these binary level files instead of the built-in levels")
+    ap.add_argument('--generate-level',metavar='OUT',help="write a random binary level of --level-size to OUT and exit")
+    ap.add_argument('--level-size',default='1024x1024',help="WIDTHxHEIGHT for --generate-level")
+    ap.add_argument('--seed',type=int,default=0,help="seed for --generate-level")
+    args=ap.parse_args(); RENDER_BANDS=args.bands; RENDER_SCALE=args.render_scale; PALETTED=args.paletted
+    if args.generate_level:
+        w,h=map(int,args.level_size.lower().split('x')); write_level_file(args.generate_level,generate_level(w,h,args.seed)); print(f"Level {w}x{h} written to {args.generate_level}"); sys.exit()
+    if args.level: LEVELS[:]=args.level; MAX_LEVELS=len(LEVELS)
+    if args.benchmark: run_benchmark(args.benchmark,args.bench_frames,band_counts=[int(b) for b in args.bench_bands.split(',')]); sys.exit()
     try: main()
     except Exception as e:
         print("\n--- UNHANDLED EXCEPTION ---"); import traceback; traceback.print_exc(); print("---------------------------\n")